@@ -3,8 +3,8 @@ import asyncio
 from fastapi import APIRouter
 from loguru import logger
 
-from .crud import db
-from .tasks import wait_for_paid_invoices
+from .crud import db, warm_uid_map
+from .tasks import purge_old_hits, wait_for_paid_invoices
 from .views import boltcards_generic_router
 from .views_api import boltcards_api_router
 from .views_lnurl import boltcards_lnurl_router
@@ -33,10 +33,15 @@ def boltcards_stop():
 
 
 def boltcards_start():
-    from lnbits.tasks import create_permanent_unique_task
+    from lnbits.tasks import create_permanent_unique_task, create_unique_task
 
     task = create_permanent_unique_task("ext_boltcards", wait_for_paid_invoices)
     scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_boltcards_retention", purge_old_hits)
+    scheduled_tasks.append(task)
+    # card programmers look cards up by UID, see `get_card_by_uid`
+    task = create_unique_task("ext_boltcards_uid_map", warm_uid_map())
+    scheduled_tasks.append(task)
 
 
 __all__ = [
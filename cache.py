@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+
+from .models import Card
+
+
+class CardCache:
+    """
+    Small in-process LRU cache for cards, addressable by `id` and `external_id`.
+    Entries expire after `ttl` seconds so that other workers' writes show up
+    eventually; writes from this process must go through `set`/`invalidate`.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cards: OrderedDict[str, tuple[float, Card]] = OrderedDict()
+        self._external_ids: dict[str, str] = {}
+
+    def get(self, card_id: str) -> Card | None:
+        entry = self._cards.get(card_id)
+        if not entry:
+            self.misses += 1
+            return None
+        expires, card = entry
+        if expires < time.monotonic():
+            self.invalidate(card_id)
+            self.misses += 1
+            return None
+        self._cards.move_to_end(card_id)
+        self.hits += 1
+        return card.copy()
+
+    def get_by_external_id(self, external_id: str) -> Card | None:
+        card_id = self._external_ids.get(external_id)
+        if not card_id:
+            self.misses += 1
+            return None
+        return self.get(card_id)
+
+    def set(self, card: Card) -> None:
+        self.invalidate(card.id)
+        self._cards[card.id] = (time.monotonic() + self.ttl, card.copy())
+        self._external_ids[card.external_id] = card.id
+        while len(self._cards) > self.maxsize:
+            _, (_, evicted) = self._cards.popitem(last=False)
+            self._external_ids.pop(evicted.external_id, None)
+
+    def update(self, card_id: str, **fields) -> None:
+        entry = self._cards.get(card_id)
+        if entry:
+            for key, value in fields.items():
+                setattr(entry[1], key, value)
+
+    def invalidate(self, card_id: str) -> None:
+        entry = self._cards.pop(card_id, None)
+        if entry:
+            self._external_ids.pop(entry[1].external_id, None)
+
+    def clear(self) -> None:
+        self._cards.clear()
+        self._external_ids.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._cards),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class UidMap:
+    """
+    UID to card id map for the card programmer, meant to hold all cards and
+    filled at startup. Entries are only hints, cards can be deleted or change
+    their UID in other workers, so lookups check the card they point to.
+    """
+
+    def __init__(self):
+        self._ids: dict[str, str] = {}
+
+    def get(self, uid: str) -> str | None:
+        return self._ids.get(uid)
+
+    def set(self, uid: str, card_id: str) -> None:
+        self._ids[uid] = card_id
+
+    def discard(self, uid: str) -> None:
+        self._ids.pop(uid, None)
+
+    def clear(self) -> None:
+        self._ids.clear()
+
+    def __len__(self) -> int:
+        return len(self._ids)
@@ -0,0 +1,135 @@
+"""
+Encrypted card archives: gzip compressed NDJSON, cut into AES-GCM frames.
+
+    archive = MAGIC | salt (16) | frame...
+    frame   = length (4, big endian) | nonce (12) | ciphertext (length) | tag (16)
+
+The key is derived from a passphrase with scrypt. Every frame authenticates
+its index and whether it is the last one, so frames can not be reordered,
+dropped or the archive truncated without failing decryption. Anyone can build
+an archive for their own passphrase, so reading it bounds the memory a frame
+and a row may take when decompressed.
+"""
+
+import asyncio
+import json
+import secrets
+import struct
+import zlib
+from collections.abc import AsyncIterable, AsyncIterator
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Protocol.KDF import scrypt
+
+MAGIC = b"BOLTCARDS1"
+FRAME_SIZE = 65536
+MAX_FRAME_SIZE = 1024 * 1024
+# a card is well below 1 KiB as JSON
+MAX_ROW_SIZE = 65536
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _key(passphrase: str, salt: bytes) -> bytes:
+    # pycryptodome's stubs declare the salt as str, but scrypt takes bytes too
+    # and the salt here is random bytes
+    key = scrypt(passphrase, salt, 32, N=2**14, r=8, p=1)  # type: ignore[arg-type]
+    assert isinstance(key, bytes)
+    return key
+
+
+def _aad(index: int, last: bool) -> bytes:
+    return struct.pack(">Q?", index, last)
+
+
+async def write_archive(
+    rows: AsyncIterable[dict], passphrase: str
+) -> AsyncIterator[bytes]:
+    salt = secrets.token_bytes(16)
+    # scrypt takes tens of milliseconds, keep it off the event loop
+    key = await asyncio.to_thread(_key, passphrase, salt)
+    yield MAGIC + salt
+
+    index = 0
+
+    def frame(plain: bytes, last: bool) -> bytes:
+        nonce = secrets.token_bytes(12)
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(_aad(index, last))
+        ciphertext, tag = cipher.encrypt_and_digest(plain)
+        return struct.pack(">I", len(ciphertext)) + nonce + ciphertext + tag
+
+    compressor = zlib.compressobj(wbits=31)
+    buffer = b""
+    async for row in rows:
+        line = json.dumps(row, separators=(",", ":"), default=str) + "\n"
+        buffer += compressor.compress(line.encode())
+        if len(buffer) >= FRAME_SIZE:
+            yield frame(buffer, last=False)
+            index += 1
+            buffer = b""
+    yield frame(buffer + compressor.flush(), last=True)
+
+
+async def read_archive(
+    chunks: AsyncIterable[bytes], passphrase: str
+) -> AsyncIterator[dict]:
+    """Decrypt and decompress an archive as it streams in, one row at a time."""
+    data = b""
+    key = None
+    index = 0
+    last = False
+    decompressor = zlib.decompressobj(wbits=31)
+    pending = b""
+
+    async for chunk in chunks:
+        data += chunk
+        if key is None:
+            if len(data) < len(MAGIC) + 16:
+                continue
+            if not data.startswith(MAGIC):
+                raise ArchiveError("Not a boltcards archive.")
+            key = await asyncio.to_thread(
+                _key, passphrase, data[len(MAGIC) : len(MAGIC) + 16]
+            )
+            data = data[len(MAGIC) + 16 :]
+        while len(data) >= 4:
+            (length,) = struct.unpack(">I", data[:4])
+            if length > MAX_FRAME_SIZE:
+                raise ArchiveError("Archive frame is too large.")
+            if len(data) < 4 + 12 + length + 16:
+                break
+            if last:
+                raise ArchiveError("Unexpected data after the end of the archive.")
+            nonce = data[4:16]
+            ciphertext = data[16 : 16 + length]
+            tag = data[16 + length : 32 + length]
+            data = data[32 + length :]
+            plain = None
+            for final in (False, True):
+                cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+                cipher.update(_aad(index, final))
+                try:
+                    plain = cipher.decrypt_and_verify(ciphertext, tag)
+                except ValueError:
+                    continue
+                last = final
+                break
+            if plain is None:
+                raise ArchiveError("Wrong passphrase or corrupted archive.")
+            index += 1
+            while plain:
+                pending += decompressor.decompress(plain, MAX_ROW_SIZE)
+                plain = decompressor.unconsumed_tail
+                *lines, pending = pending.split(b"\n")
+                if len(pending) > MAX_ROW_SIZE:
+                    raise ArchiveError("Archive row is too large.")
+                for line in lines:
+                    if len(line) > MAX_ROW_SIZE:
+                        raise ArchiveError("Archive row is too large.")
+                    yield json.loads(line)
+
+    if key is None or data or not last:
+        raise ArchiveError("Archive is truncated.")
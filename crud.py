@@ -1,19 +1,27 @@
 import secrets
-from datetime import datetime
+import sqlite3
+from datetime import datetime, timezone
+from typing import TypeVar
 
-from lnbits.db import Database
+from lnbits.db import SQLITE, Connection, Database, dict_to_model
 from lnbits.helpers import urlsafe_short_hash
 
-from .models import Card, CreateCardData, Hit, Refund
+from .cache import CardCache, UidMap
+from .models import ZERO_KEY, Card, CardDailySpend, CreateCardData, Hit, Refund
+
+T = TypeVar("T", Card, Hit, Refund)
+
+# 13 bound values per card stay below sqlite's limit of 32766 variables
+CARDS_CHUNK_SIZE = 1000
 
 db = Database("ext_boltcards")
+card_cache = CardCache()
+uid_map = UidMap()
 
 
 async def create_card(data: CreateCardData, wallet_id: str) -> Card:
-    card_id = urlsafe_short_hash().upper()
-    extenal_id = urlsafe_short_hash().lower()
-
-    await db.execute(
+    card = await _insert_returning(
+        "boltcards.cards",
         """
         INSERT INTO boltcards.cards (
             id,
@@ -35,64 +43,221 @@ async def create_card(data: CreateCardData, wallet_id: str) -> Card:
             :tx_limit, :daily_limit, :enable, :k0, :k1, :k2, :otp
         )
         """,
-        {
-            "id": card_id,
-            "uid": data.uid.upper(),
-            "external_id": extenal_id,
-            "wallet": wallet_id,
-            "card_name": data.card_name,
-            "counter": data.counter,
-            "tx_limit": data.tx_limit,
-            "daily_limit": data.daily_limit,
-            "enable": True,
-            "k0": data.k0,
-            "k1": data.k1,
-            "k2": data.k2,
-            "otp": secrets.token_hex(16),
-        },
+        _card_values(data, wallet_id),
+        Card,
     )
-    card = await get_card(card_id)
-    assert card, "Newly created card couldn't be retrieved"
+    card_cache.set(card)
+    uid_map.set(card.uid, card.id)
     return card
 
 
+async def create_cards(cards: list[CreateCardData], wallet_id: str) -> list[Card]:
+    """
+    Insert many cards with multi-row inserts on one connection. The caller is
+    expected to have checked the UIDs, the cards are returned in input order.
+    """
+    rows = [_card_values(data, wallet_id) for data in cards]
+    created: list[Card] = []
+    async with db.connect() as conn:
+        for start in range(0, len(rows), CARDS_CHUNK_SIZE):
+            chunk = rows[start : start + CARDS_CHUNK_SIZE]
+            if _supports_returning():
+                result = await _insert_card_rows(conn, chunk, " RETURNING *")
+                created.extend(dict_to_model(row, Card) for row in result.mappings())
+            else:
+                await _insert_card_rows(conn, chunk)
+    if not _supports_returning():
+        created = await get_cards_by_ids([row["id"] for row in rows])
+    for row in rows:
+        uid_map.set(row["uid"], row["id"])
+    order = {row["id"]: i for i, row in enumerate(rows)}
+    return sorted(created, key=lambda card: order[card.id])
+
+
+async def import_cards(new: list[Card], replaced: list[Card]) -> None:
+    """Insert new and overwrite existing cards, all rows as given."""
+    async with db.connect() as conn:
+        rows = [card.dict() for card in new]
+        for start in range(0, len(rows), CARDS_CHUNK_SIZE):
+            await _insert_card_rows(conn, rows[start : start + CARDS_CHUNK_SIZE])
+        for card in replaced:
+            await conn.update("boltcards.cards", card)
+    for card in replaced:
+        card_cache.invalidate(card.id)
+    for card in new + replaced:
+        uid_map.set(card.uid, card.id)
+
+
+async def _insert_card_rows(conn: Connection, rows: list[dict], returning: str = ""):
+    """One multi-row insert of `rows`, which all have the same columns."""
+    values: dict = {}
+    placeholders = []
+    for i, row in enumerate(rows):
+        names = []
+        for key, value in row.items():
+            values[f"{key}_{i}"] = value
+            if isinstance(value, datetime):
+                names.append(db.timestamp_placeholder(f"{key}_{i}"))
+            else:
+                names.append(f":{key}_{i}")
+        placeholders.append(f"({', '.join(names)})")
+    return await conn.execute(
+        f"""
+        INSERT INTO boltcards.cards ({", ".join(rows[0])})
+        VALUES {", ".join(placeholders)}{returning}
+        """,
+        values,
+    )
+
+
+def _card_values(data: CreateCardData, wallet_id: str) -> dict:
+    return {
+        "id": urlsafe_short_hash().upper(),
+        "uid": data.uid,
+        "external_id": urlsafe_short_hash().lower(),
+        "wallet": wallet_id,
+        "card_name": data.card_name,
+        "counter": data.counter,
+        "tx_limit": data.tx_limit,
+        "daily_limit": data.daily_limit,
+        "enable": True,
+        "k0": data.k0,
+        "k1": data.k1,
+        "k2": data.k2,
+        "otp": secrets.token_hex(16),
+    }
+
+
 async def update_card(card: Card) -> Card:
     await db.update("boltcards.cards", card)
+    card_cache.set(card)
+    uid_map.set(card.uid, card.id)
     return card
 
 
 async def get_cards(wallet_ids: list[str]) -> list[Card]:
     if len(wallet_ids) == 0:
         return []
-    q = ",".join([f"'{wallet_id}'" for wallet_id in wallet_ids])
+    q, values = _in_params("wallet", wallet_ids)
     return await db.fetchall(
         f"SELECT * FROM boltcards.cards WHERE wallet IN ({q})",
-        model=Card,
+        values,
+        Card,
+    )
+
+
+async def get_wallet_cards_after(
+    wallet_id: str, after: str | None, limit: int
+) -> list[Card]:
+    """Cards of a wallet ordered by id, for reading all of them in chunks."""
+    where = "wallet = :wallet"
+    if after:
+        where += " AND id > :after"
+    return await db.fetchall(
+        f"SELECT * FROM boltcards.cards WHERE {where} ORDER BY id {_limit(limit)}",
+        {"wallet": wallet_id, "after": after},
+        Card,
     )
 
 
 async def get_card(card_id: str) -> Card | None:
-    return await db.fetchone(
+    card = card_cache.get(card_id)
+    if card:
+        return card
+    card = await db.fetchone(
         "SELECT * FROM boltcards.cards WHERE id = :id",
         {"id": card_id},
         Card,
     )
+    if card:
+        card_cache.set(card)
+    return card
+
+
+async def get_cards_by_ids(card_ids: list[str]) -> list[Card]:
+    if len(card_ids) == 0:
+        return []
+    q, values = _in_params("id", card_ids)
+    return await db.fetchall(
+        f"SELECT * FROM boltcards.cards WHERE id IN ({q})",
+        values,
+        Card,
+    )
+
+
+async def get_cards_by_uids(card_uids: list[str]) -> list[Card]:
+    if len(card_uids) == 0:
+        return []
+    q, values = _in_params("uid", [uid.upper() for uid in card_uids])
+    return await db.fetchall(
+        f"SELECT * FROM boltcards.cards WHERE uid IN ({q})",
+        values,
+        Card,
+    )
 
 
 async def get_card_by_uid(card_uid: str) -> Card | None:
-    return await db.fetchone(
+    # stored UIDs are upper case, so the unique index on uid serves the query
+    uid = card_uid.upper()
+    card_id = uid_map.get(uid)
+    if card_id:
+        card = await get_card(card_id)
+        if card and card.uid == uid:
+            return card
+    card = await db.fetchone(
         "SELECT * FROM boltcards.cards WHERE uid = :uid",
-        {"uid": card_uid.upper()},
+        {"uid": uid},
         Card,
     )
+    if card:
+        card_cache.set(card)
+        uid_map.set(card.uid, card.id)
+    else:
+        uid_map.discard(uid)
+    return card
+
+
+async def warm_uid_map() -> int:
+    """Fill `uid_map` with all cards, in chunks ordered by id."""
+    after = ""
+    while True:
+        rows = await db.fetchall(
+            f"""
+            SELECT id, uid FROM boltcards.cards WHERE id > :after
+            ORDER BY id {_limit(CARDS_CHUNK_SIZE)}
+            """,
+            {"after": after},
+        )
+        for row in rows:
+            uid_map.set(row["uid"], row["id"])
+        if len(rows) < CARDS_CHUNK_SIZE:
+            return len(uid_map)
+        after = rows[-1]["id"]
 
 
 async def get_card_by_external_id(external_id: str) -> Card | None:
-    return await db.fetchone(
+    card = card_cache.get_by_external_id(external_id.lower())
+    if card:
+        return card
+    card = await db.fetchone(
         "SELECT * FROM boltcards.cards WHERE external_id = :ext_id",
         {"ext_id": external_id.lower()},
         Card,
     )
+    if card:
+        card_cache.set(card)
+    return card
+
+
+async def get_cards_by_external_ids(external_ids: list[str]) -> list[Card]:
+    if len(external_ids) == 0:
+        return []
+    q, values = _in_params("ext_id", [ext_id.lower() for ext_id in external_ids])
+    return await db.fetchall(
+        f"SELECT * FROM boltcards.cards WHERE external_id IN ({q})",
+        values,
+        Card,
+    )
 
 
 async def get_card_by_otp(otp: str) -> Card | None:
@@ -104,25 +269,52 @@ async def get_card_by_otp(otp: str) -> Card | None:
 
 
 async def delete_card(card_id: str) -> None:
-    # Delete cards
-    await db.execute("DELETE FROM boltcards.cards WHERE id = :id", {"id": card_id})
-    # Delete hits
-    hits = await get_hits([card_id])
-    for hit in hits:
-        await db.execute("DELETE FROM boltcards.hits WHERE id = :id", {"id": hit.id})
-        # Delete refunds
-        refunds = await get_refunds([hit.id])
-        for refund in refunds:
-            await db.execute(
-                "DELETE FROM boltcards.refunds WHERE id = :id", {"id": refund.id}
+    await delete_cards([card_id])
+
+
+async def delete_cards(card_ids: list[str]) -> None:
+    """
+    Delete cards with their hits and refunds. Children go first, so an
+    interrupted delete leaves the card in place and can simply be retried.
+    """
+    if len(card_ids) == 0:
+        return
+    q, values = _in_params("card_id", card_ids)
+    async with db.connect() as conn:
+        await conn.execute(
+            f"""
+            DELETE FROM boltcards.refunds WHERE hit_id IN (
+                SELECT id FROM boltcards.hits WHERE card_id IN ({q})
             )
+            """,
+            values,
+        )
+        await conn.execute(f"DELETE FROM boltcards.hits WHERE card_id IN ({q})", values)
+        await conn.execute(
+            f"DELETE FROM boltcards.card_daily_spend WHERE card_id IN ({q})", values
+        )
+        await conn.execute(f"DELETE FROM boltcards.cards WHERE id IN ({q})", values)
+    for card_id in card_ids:
+        card_cache.invalidate(card_id)
 
 
-async def update_card_counter(counter: int, card_id: str):
-    await db.execute(
-        "UPDATE boltcards.cards SET counter = :counter WHERE id = :id",
+async def update_card_counter(counter: int, card_id: str) -> bool:
+    """
+    Advance the card counter if `counter` is higher than the stored one.
+    Returns False if the counter was already used (replay or concurrent tap).
+    """
+    result = await db.execute(
+        """
+        UPDATE boltcards.cards SET counter = :counter
+        WHERE id = :id AND counter < :counter
+        """,
         {"counter": counter, "id": card_id},
     )
+    if result.rowcount != 1:
+        card_cache.invalidate(card_id)
+        return False
+    card_cache.update(card_id, counter=counter)
+    return True
 
 
 async def enable_disable_card(enable: bool, card_id: str) -> Card | None:
@@ -130,14 +322,35 @@ async def enable_disable_card(enable: bool, card_id: str) -> Card | None:
         "UPDATE boltcards.cards SET enable = :enable WHERE id = :id",
         {"enable": enable, "id": card_id},
     )
+    card_cache.invalidate(card_id)
     return await get_card(card_id)
 
 
+async def retire_previous_keys(card_id: str) -> None:
+    """Forget the keys a card had before a rotation, once it uses the new ones."""
+    await db.execute(
+        """
+        UPDATE boltcards.cards
+        SET prev_k0 = :zero, prev_k1 = :zero, prev_k2 = :zero, rotating = :rotating
+        WHERE id = :id
+        """,
+        {"zero": ZERO_KEY, "rotating": False, "id": card_id},
+    )
+    card_cache.update(
+        card_id,
+        prev_k0=ZERO_KEY,
+        prev_k1=ZERO_KEY,
+        prev_k2=ZERO_KEY,
+        rotating=False,
+    )
+
+
 async def update_card_otp(otp: str, card_id: str):
     await db.execute(
         "UPDATE boltcards.cards SET otp = :otp WHERE id = :id",
         {"otp": otp, "id": card_id},
     )
+    card_cache.update(card_id, otp=otp)
 
 
 async def get_hit(hit_id: str) -> Hit | None:
@@ -148,42 +361,176 @@ async def get_hit(hit_id: str) -> Hit | None:
     )
 
 
-async def get_hits(cards_ids: list[str]) -> list[Hit]:
+async def get_hits(
+    cards_ids: list[str],
+    since: datetime | None = None,
+    until: datetime | None = None,
+    before: tuple[datetime, str] | None = None,
+    limit: int | None = None,
+) -> list[Hit]:
+    """
+    Hits of the given cards, newest first. `before` is the (time, id) of the
+    last hit of the previous page.
+    """
     if len(cards_ids) == 0:
         return []
-
-    q = ",".join([f"'{card_id}'" for card_id in cards_ids])
+    q, values = _in_params("card_id", cards_ids)
+    where, window_values = _window_filters("time", "id", since, until, before)
+    values.update(window_values)
     return await db.fetchall(
-        f"SELECT * FROM boltcards.hits WHERE card_id IN ({q})",
-        model=Hit,
+        f"""
+        SELECT * FROM boltcards.hits WHERE card_id IN ({q}) {where}
+        ORDER BY time DESC, id DESC {_limit(limit)}
+        """,
+        values,
+        Hit,
     )
 
 
-async def get_hits_today(card_id: str) -> list[Hit]:
-    rows = await db.fetchall(
-        "SELECT * FROM boltcards.hits WHERE card_id = :id",
-        {"id": card_id},
-        Hit,
+async def get_spent_today(card_id: str) -> int:
+    row: dict = await db.fetchone(
+        """
+        SELECT spent_msat FROM boltcards.card_daily_spend
+        WHERE card_id = :card_id AND day = :day
+        """,
+        {"card_id": card_id, "day": _day(datetime.now(timezone.utc))},
     )
-    updatedrow = []
-    for hit in rows:
-        if datetime.now().date() == hit.time.date():
-            updatedrow.append(hit)
+    return int(row["spent_msat"]) // 1000 if row else 0
+
 
-    return updatedrow
+async def get_card_daily_spend(
+    card_id: str, since: datetime | None = None
+) -> list[CardDailySpend]:
+    where = ""
+    values = {"card_id": card_id}
+    if since:
+        where = "AND day >= :since"
+        values["since"] = _day(since)
+    return await db.fetchall(
+        f"""
+        SELECT * FROM boltcards.card_daily_spend
+        WHERE card_id = :card_id {where} ORDER BY day DESC
+        """,
+        values,
+        CardDailySpend,
+    )
 
 
-async def spend_hit(card_id: str, amount: int):
+async def add_card_daily_spend(
+    card_id: str,
+    time: datetime,
+    spent_msat: int = 0,
+    tap_count: int = 0,
+    refund_total: int = 0,
+) -> None:
     await db.execute(
-        "UPDATE boltcards.hits SET spent = :spent, amount = :amount WHERE id = :id",
-        {"spent": True, "amount": amount, "id": card_id},
+        """
+        INSERT INTO boltcards.card_daily_spend AS daily (
+            card_id, day, spent_msat, tap_count, refund_total
+        )
+        VALUES (:card_id, :day, :spent_msat, :tap_count, :refund_total)
+        ON CONFLICT (card_id, day) DO UPDATE SET
+            spent_msat = daily.spent_msat + excluded.spent_msat,
+            tap_count = daily.tap_count + excluded.tap_count,
+            refund_total = daily.refund_total + excluded.refund_total
+        """,
+        {
+            "card_id": card_id,
+            "day": _day(time),
+            "spent_msat": spent_msat,
+            "tap_count": tap_count,
+            "refund_total": refund_total,
+        },
     )
-    return await get_hit(card_id)
 
 
-async def create_hit(card_id, ip, useragent, old_ctr, new_ctr) -> Hit:
+async def spend_hit(hit_id: str, amount: int) -> Hit | None:
+    """
+    Claim an unspent hit and record the amount in one statement.
+    Returns None if the hit does not exist or was already spent.
+    """
+    values = {"spent": True, "unspent": False, "amount": amount, "id": hit_id}
+    query = """
+        UPDATE boltcards.hits SET spent = :spent, amount = :amount
+        WHERE id = :id AND spent = :unspent
+    """
+    if not _supports_returning():
+        result = await db.execute(query, values)
+        hit = await get_hit(hit_id) if result.rowcount == 1 else None
+    else:
+        result = await db.execute(f"{query} RETURNING *", values)
+        row = result.mappings().first()
+        hit = dict_to_model(row, Hit) if row else None
+    if hit:
+        await add_card_daily_spend(
+            hit.card_id, hit.time, spent_msat=amount * 1000, tap_count=1
+        )
+    return hit
+
+
+def _supports_returning() -> bool:
+    return db.type != SQLITE or sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+async def _insert_returning(table: str, query: str, values: dict, model: type[T]) -> T:
+    """
+    Insert a row and return it as `model`, with the defaults filled in by the
+    database. Uses RETURNING so that this is a single round trip.
+    """
+    if _supports_returning():
+        result = await db.execute(f"{query} RETURNING *", values)
+        row = result.mappings().first()
+    else:
+        await db.execute(query, values)
+        row = await db.fetchone(
+            f"SELECT * FROM {table} WHERE id = :id", {"id": values["id"]}
+        )
+    assert row, f"Newly created row in {table} couldn't be retrieved"
+    return dict_to_model(row, model)
+
+
+async def get_hits_by_ids(hits_ids: list[str]) -> list[Hit]:
+    if len(hits_ids) == 0:
+        return []
+    q, values = _in_params("id", hits_ids)
+    return await db.fetchall(
+        f"SELECT * FROM boltcards.hits WHERE id IN ({q})",
+        values,
+        Hit,
+    )
+
+
+async def get_hits_before(before: datetime, limit: int) -> list[Hit]:
+    """Oldest hits created before `before`, for archiving."""
+    return await db.fetchall(
+        f"""
+        SELECT * FROM boltcards.hits
+        WHERE time < {db.timestamp_placeholder('before')}
+        ORDER BY time ASC, id ASC LIMIT {int(limit)}
+        """,
+        {"before": before},
+        Hit,
+    )
+
+
+async def delete_hits(hits_ids: list[str]) -> None:
+    """Delete hits and their refunds."""
+    if len(hits_ids) == 0:
+        return
+    q, values = _in_params("hit_id", hits_ids)
+    async with db.connect() as conn:
+        await conn.execute(
+            f"DELETE FROM boltcards.refunds WHERE hit_id IN ({q})", values
+        )
+        await conn.execute(f"DELETE FROM boltcards.hits WHERE id IN ({q})", values)
+
+
+async def create_hit(
+    card_id, ip, useragent, old_ctr, new_ctr, key_version: int = 0
+) -> Hit:
     hit_id = urlsafe_short_hash()
-    await db.execute(
+    return await _insert_returning(
+        "boltcards.hits",
         """
         INSERT INTO boltcards.hits (
             id,
@@ -193,9 +540,13 @@ async def create_hit(card_id, ip, useragent, old_ctr, new_ctr) -> Hit:
             useragent,
             old_ctr,
             new_ctr,
-            amount
+            amount,
+            key_version
+        )
+        VALUES (
+            :id, :card_id, :ip, :spent, :useragent, :old_ctr, :new_ctr, :amount,
+            :key_version
         )
-        VALUES (:id, :card_id, :ip, :spent, :useragent, :old_ctr, :new_ctr, :amount)
         """,
         {
             "id": hit_id,
@@ -206,16 +557,16 @@ async def create_hit(card_id, ip, useragent, old_ctr, new_ctr) -> Hit:
             "old_ctr": old_ctr,
             "new_ctr": new_ctr,
             "amount": 0,
+            "key_version": key_version,
         },
+        Hit,
     )
-    hit = await get_hit(hit_id)
-    assert hit, "Newly recorded hit couldn't be retrieved"
-    return hit
 
 
 async def create_refund(hit_id, refund_amount) -> Refund:
     refund_id = urlsafe_short_hash()
-    await db.execute(
+    return await _insert_returning(
+        "boltcards.refunds",
         """
         INSERT INTO boltcards.refunds (
             id,
@@ -229,10 +580,69 @@ async def create_refund(hit_id, refund_amount) -> Refund:
             "hit_id": hit_id,
             "refund_amount": refund_amount,
         },
+        Refund,
+    )
+
+
+async def create_refunds(refunds: list[tuple[str, int, str]]) -> list[Refund]:
+    """
+    Record (hit_id, refund_amount, payment_hash) refunds with one multi-row
+    insert. Payment hashes that are already recorded are skipped, only the
+    newly created refunds are returned.
+    """
+    if len(refunds) == 0:
+        return []
+    q, values = _in_params("payment_hash", [refund[2] for refund in refunds])
+    existing = await db.fetchall(
+        f"SELECT payment_hash FROM boltcards.refunds WHERE payment_hash IN ({q})",
+        values,
+    )
+    recorded = {row["payment_hash"] for row in existing}
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    new_refunds: dict[str, Refund] = {}
+    for hit_id, refund_amount, payment_hash in refunds:
+        if payment_hash in recorded or payment_hash in new_refunds:
+            continue
+        new_refunds[payment_hash] = Refund(
+            id=urlsafe_short_hash(),
+            hit_id=hit_id,
+            refund_amount=refund_amount,
+            time=now,
+            payment_hash=payment_hash,
+        )
+    if not new_refunds:
+        return []
+
+    rows = []
+    values = {"time": now}
+    time_placeholder = db.timestamp_placeholder("time")
+    for i, refund in enumerate(new_refunds.values()):
+        rows.append(
+            f"(:id_{i}, :hit_id_{i}, :amount_{i}, :hash_{i}, {time_placeholder})"
+        )
+        values[f"id_{i}"] = refund.id
+        values[f"hit_id_{i}"] = refund.hit_id
+        values[f"amount_{i}"] = refund.refund_amount
+        values[f"hash_{i}"] = refund.payment_hash
+    # a concurrent insert of the same payment hash can slip in after the
+    # select above, so only the rows actually inserted are returned
+    returning = " RETURNING *" if _supports_returning() else ""
+    result = await db.execute(
+        f"""
+        INSERT INTO boltcards.refunds (
+            id, hit_id, refund_amount, payment_hash, time
+        )
+        VALUES {", ".join(rows)}
+        ON CONFLICT (payment_hash) DO NOTHING{returning}
+        """,
+        values,
+    )
+    if returning:
+        return [dict_to_model(row, Refund) for row in result.mappings()]
+    q, values = _in_params("id", [refund.id for refund in new_refunds.values()])
+    return await db.fetchall(
+        f"SELECT * FROM boltcards.refunds WHERE id IN ({q})", values, Refund
     )
-    refund = await get_refund(refund_id)
-    assert refund, "Newly recorded hit couldn't be retrieved"
-    return refund
 
 
 async def get_refund(refund_id: str) -> Refund | None:
@@ -246,8 +656,94 @@ async def get_refund(refund_id: str) -> Refund | None:
 async def get_refunds(hits_ids: list[str]) -> list[Refund]:
     if len(hits_ids) == 0:
         return []
-    q = ",".join([f"'{hit_id}'" for hit_id in hits_ids])
+    q, values = _in_params("hit_id", hits_ids)
     return await db.fetchall(
         f"SELECT * FROM boltcards.refunds WHERE hit_id IN ({q})",
-        model=Refund,
+        values,
+        Refund,
+    )
+
+
+async def get_card_refunds(card_id: str) -> list[Refund]:
+    """Refunds of a card, joined on its hits instead of listing their ids."""
+    return await db.fetchall(
+        """
+        SELECT refunds.* FROM boltcards.refunds AS refunds
+        JOIN boltcards.hits AS hits ON hits.id = refunds.hit_id
+        WHERE hits.card_id = :card_id
+        """,
+        {"card_id": card_id},
+        Refund,
+    )
+
+
+async def get_wallets_refunds(
+    wallet_ids: list[str],
+    card_id: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    before: tuple[datetime, str] | None = None,
+    limit: int | None = None,
+) -> list[Refund]:
+    """Refunds of all cards of the given wallets, paginated like `get_hits`."""
+    if len(wallet_ids) == 0:
+        return []
+    q, values = _in_params("wallet", wallet_ids)
+    where, window_values = _window_filters(
+        "refunds.time", "refunds.id", since, until, before
+    )
+    values.update(window_values)
+    if card_id:
+        where += " AND cards.id = :card_id"
+        values["card_id"] = card_id
+    return await db.fetchall(
+        f"""
+        SELECT refunds.* FROM boltcards.refunds AS refunds
+        JOIN boltcards.hits AS hits ON hits.id = refunds.hit_id
+        JOIN boltcards.cards AS cards ON cards.id = hits.card_id
+        WHERE cards.wallet IN ({q}) {where}
+        ORDER BY refunds.time DESC, refunds.id DESC {_limit(limit)}
+        """,
+        values,
+        Refund,
     )
+
+
+def _in_params(name: str, items: list) -> tuple[str, dict]:
+    """Bound placeholders for an IN (...) clause, e.g. `:id_0, :id_1`."""
+    values = {f"{name}_{i}": item for i, item in enumerate(items)}
+    return ", ".join(f":{key}" for key in values), values
+
+
+def _window_filters(
+    time_column: str,
+    id_column: str,
+    since: datetime | None,
+    until: datetime | None,
+    before: tuple[datetime, str] | None,
+) -> tuple[str, dict]:
+    """`AND ...` conditions for a time window and a (time, id) keyset cursor."""
+    where = ""
+    values: dict = {}
+    if since:
+        where += f" AND {time_column} >= {db.timestamp_placeholder('since')}"
+        values["since"] = since
+    if until:
+        where += f" AND {time_column} < {db.timestamp_placeholder('until')}"
+        values["until"] = until
+    if before:
+        before_time = db.timestamp_placeholder("before_time")
+        where += (
+            f" AND ({time_column} < {before_time}"
+            f" OR ({time_column} = {before_time} AND {id_column} < :before_id))"
+        )
+        values["before_time"], values["before_id"] = before
+    return where, values
+
+
+def _limit(limit: int | None) -> str:
+    return f"LIMIT {int(limit)}" if limit else ""
+
+
+def _day(time: datetime) -> str:
+    return time.strftime("%Y-%m-%d")
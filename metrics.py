@@ -0,0 +1,213 @@
+import json
+import time
+from collections.abc import Callable, Coroutine, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+
+from fastapi import HTTPException, Request, Response
+from fastapi.routing import APIRoute
+from loguru import logger
+
+from .settings import boltcards_settings
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], **extra: str) -> str:
+    pairs = [*zip(names, values, strict=True), *extra.items()]
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...],
+        buckets: tuple[float, ...] = BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label set: counts per bucket (non cumulative), sum and count
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        entry = self._values.get(key)
+        if not entry:
+            entry = self._values[key] = ([0] * len(self.buckets), [0.0, 0.0])
+        counts, totals = entry
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        totals[0] += value
+        totals[1] += 1
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return int(entry[1][1]) if entry else 0
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for key, (counts, (total, count)) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts, strict=True):
+                cumulative += bucket
+                labels = _labels(self.labelnames, key, le=str(bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labelnames, key, le="+Inf")
+            lines.append(f"{self.name}_bucket{labels} {int(count)}")
+            labels = _labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {int(count)}")
+        return lines
+
+
+request_seconds = Histogram(
+    "boltcards_request_seconds",
+    "Latency of the LNURL endpoints.",
+    ("endpoint",),
+)
+stage_seconds = Histogram(
+    "boltcards_stage_seconds",
+    "Time spent in each stage of the tap and payment pipeline.",
+    ("stage",),
+)
+errors_total = Counter(
+    "boltcards_errors_total",
+    "Error responses of the LNURL endpoints and failed background work by reason.",
+    ("endpoint", "reason"),
+)
+
+# stage timings of the current request, only set when slow requests are traced
+_trace: ContextVar[list[tuple[str, float]] | None] = ContextVar(
+    "boltcards_trace", default=None
+)
+refunds_total = Counter(
+    "boltcards_refunds_total",
+    "Paid refund invoices recorded by the payment workers.",
+    (),
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a block of work as `name` in `boltcards_stage_seconds`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(seconds, stage=name)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((name, seconds))
+
+
+def render() -> str:
+    lines: list[str] = []
+    for metric in (request_seconds, stage_seconds, errors_total, refunds_total):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _error_reason(response: Response) -> str | None:
+    body = getattr(response, "body", b"")
+    if b'"ERROR"' not in body:
+        return None
+    try:
+        reason = str(json.loads(body).get("reason"))
+    except ValueError:
+        return None
+    # keep the label set bounded, e.g. "Payment failed - <error>"
+    return reason.split(" - ")[0]
+
+
+def _log_slow_request(
+    request: Request, endpoint: str, seconds: float, trace: list[tuple[str, float]]
+) -> None:
+    stages = {name: round(stage * 1000, 2) for name, stage in trace}
+    stages["other"] = round((seconds - sum(stage for _, stage in trace)) * 1000, 2)
+    breakdown = ", ".join(f"{name}={ms}ms" for name, ms in stages.items())
+    logger.bind(
+        endpoint=endpoint,
+        path_params=request.path_params,
+        total_ms=round(seconds * 1000, 2),
+        stages=stages,
+    ).warning(f"boltcards: slow {endpoint} took {seconds * 1000:.0f}ms: {breakdown}")
+
+
+class MetricsRoute(APIRoute):
+    """
+    Records latency and LNURL error reasons of every request to the route.
+    With `BOLTCARDS_SLOW_REQUEST_MS` set, requests slower than that are logged
+    with the time spent in each `stage`.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        endpoint = self.name
+
+        async def timed_handler(request: Request) -> Response:
+            slow_ms = boltcards_settings.slow_request_ms
+            trace: list[tuple[str, float]] = []
+            token = _trace.set(trace) if slow_ms > 0 else None
+            start = time.perf_counter()
+            try:
+                response = await handler(request)
+            except HTTPException as exc:
+                errors_total.inc(endpoint=endpoint, reason=str(exc.detail))
+                raise
+            except Exception:
+                errors_total.inc(endpoint=endpoint, reason="Internal error.")
+                raise
+            finally:
+                seconds = time.perf_counter() - start
+                request_seconds.observe(seconds, endpoint=endpoint)
+                if token:
+                    _trace.reset(token)
+                    if seconds * 1000 >= slow_ms:
+                        _log_slow_request(request, endpoint, seconds, trace)
+            reason = _error_reason(response)
+            if reason:
+                errors_total.inc(endpoint=endpoint, reason=reason)
+            return response
+
+        return timed_handler
@@ -1,3 +1,6 @@
+from lnbits.db import SQLITE
+
+
 async def m001_initial(db):
     await db.execute(
         """
@@ -128,3 +131,148 @@ async def m002_correct_typing(db):
     """
     )
     await db.execute("DROP TABLE boltcards.cards_m001;")
+
+
+async def m003_hits_card_time_index(db):
+    """
+    Composite index used by the per-tap daily limit aggregation.
+    """
+    await _create_index(db, "hits_card_id_time_idx", "hits", "card_id, time")
+
+
+async def m004_lookup_indexes(db):
+    """
+    Indexes for the columns the dashboard and the auth endpoint filter on.
+    hits.card_id is already covered by hits_card_id_time_idx.
+    """
+    await _create_index(db, "refunds_hit_id_idx", "refunds", "hit_id")
+    await _create_index(db, "cards_wallet_idx", "cards", "wallet")
+    await _create_index(db, "cards_otp_idx", "cards", "otp")
+
+
+async def m005_card_daily_spend(db):
+    """
+    Per card and UTC day rollup of spent and refunded amounts (msat),
+    backfilled from the existing hits and refunds.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE boltcards.card_daily_spend (
+            card_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            spent_msat {db.big_int} NOT NULL DEFAULT 0,
+            tap_count INT NOT NULL DEFAULT 0,
+            refund_total {db.big_int} NOT NULL DEFAULT 0,
+            PRIMARY KEY (card_id, day)
+        );
+    """
+    )
+    if db.type == SQLITE:
+        hit_day = "strftime('%Y-%m-%d', hits.time, 'unixepoch')"
+        refund_day = "strftime('%Y-%m-%d', refunds.time, 'unixepoch')"
+    else:
+        hit_day = "to_char(hits.time, 'YYYY-MM-DD')"
+        refund_day = "to_char(refunds.time, 'YYYY-MM-DD')"
+    await db.execute(
+        f"""
+        INSERT INTO boltcards.card_daily_spend (
+            card_id, day, spent_msat, tap_count
+        )
+        SELECT hits.card_id, {hit_day}, SUM(hits.amount) * 1000, COUNT(*)
+        FROM boltcards.hits AS hits
+        WHERE hits.spent = true
+        GROUP BY hits.card_id, {hit_day};
+    """
+    )
+    await db.execute(
+        f"""
+        INSERT INTO boltcards.card_daily_spend AS daily (
+            card_id, day, refund_total
+        )
+        SELECT hits.card_id, {refund_day}, SUM(refunds.refund_amount) * 1000
+        FROM boltcards.refunds AS refunds
+        JOIN boltcards.hits AS hits ON hits.id = refunds.hit_id
+        WHERE true
+        GROUP BY hits.card_id, {refund_day}
+        ON CONFLICT (card_id, day) DO UPDATE
+        SET refund_total = excluded.refund_total;
+    """
+    )
+
+
+async def m006_refunds_payment_hash(db):
+    """
+    Payment hash of the refund invoice, unique so replayed payments
+    cannot be recorded twice.
+    """
+    await db.execute("ALTER TABLE boltcards.refunds ADD COLUMN payment_hash TEXT;")
+    if db.type == SQLITE:
+        await db.execute(
+            "CREATE UNIQUE INDEX boltcards.refunds_payment_hash_idx "
+            "ON refunds (payment_hash);"
+        )
+    else:
+        await db.execute(
+            "CREATE UNIQUE INDEX refunds_payment_hash_idx "
+            "ON boltcards.refunds (payment_hash);"
+        )
+
+
+async def m007_normalize_card_hex(db):
+    """
+    Store UIDs upper case and keys lower case, as the models now normalize
+    them, so that taps and UID lookups compare them without converting.
+    """
+    keys = ", ".join(
+        f"{key} = LOWER({key})"
+        for key in ("k0", "k1", "k2", "prev_k0", "prev_k1", "prev_k2")
+    )
+    await db.execute(f"UPDATE boltcards.cards SET {keys};")
+    # of UIDs that only differ in case, one is stored upper case: the one that
+    # already is, or else the one with the lowest id. the subquery must not
+    # depend on rows updated by the same statement, postgres does not see them
+    await db.execute(
+        """
+        UPDATE boltcards.cards SET uid = UPPER(uid)
+        WHERE uid <> UPPER(uid) AND NOT EXISTS (
+            SELECT 1 FROM boltcards.cards AS other
+            WHERE UPPER(other.uid) = UPPER(cards.uid)
+            AND (other.uid = UPPER(other.uid) OR other.id < cards.id)
+        );
+    """
+    )
+
+
+async def m008_hits_key_version(db):
+    """
+    Which key set verified a hit: 0 for the current keys, 1 for the previous
+    keys of a card whose keys were rotated but that is not reprogrammed yet.
+    Only cards rotated from now on accept their previous keys, the ones the
+    edit dialog kept so far were replaced on purpose.
+    """
+    await db.execute(
+        "ALTER TABLE boltcards.hits ADD COLUMN key_version INTEGER NOT NULL DEFAULT 0;"
+    )
+    await db.execute(
+        "ALTER TABLE boltcards.cards "
+        "ADD COLUMN rotating BOOLEAN NOT NULL DEFAULT false;"
+    )
+
+
+async def m009_hits_time_index(db):
+    """
+    Index for the retention job, which archives the oldest hits in batches.
+    """
+    await _create_index(db, "hits_time_id_idx", "hits", "time, id")
+
+
+async def _create_index(db, name: str, table: str, columns: str):
+    # sqlite wants the schema on the index name, postgres on the table name
+    if db.type == SQLITE:
+        await db.execute(
+            f"CREATE INDEX IF NOT EXISTS boltcards.{name} ON {table} ({columns});"
+        )
+    else:
+        await db.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON boltcards.{table} ({columns});"
+        )
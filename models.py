@@ -1,13 +1,26 @@
 import json
+from collections.abc import Iterator
 from datetime import datetime
 
 from fastapi import Query, Request
 from lnurl import Lnurl
 from lnurl import encode as lnurl_encode
 from lnurl.types import LnurlPayMetadata
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, validator
+
+from .nxp424 import SunKeys, get_sun_keys
 
 ZERO_KEY = "00000000000000000000000000000000"
+KEYS = ("k0", "k1", "k2", "prev_k0", "prev_k1", "prev_k2")
+
+
+# hex is stored with upper case UIDs and lower case keys
+def _upper(value: str) -> str:
+    return value.upper()
+
+
+def _lower(value: str) -> str:
+    return value.lower()
 
 
 class Card(BaseModel):
@@ -28,6 +41,24 @@ class Card(BaseModel):
     prev_k2: str
     otp: str
     time: datetime
+    # set by a key rotation until the card taps with its new keys, the edit
+    # dialog also keeps replaced keys in prev_k0..prev_k2 but those are retired
+    rotating: bool = False
+
+    _normalize_uid = validator("uid", allow_reuse=True)(_upper)
+    _normalize_keys = validator(*KEYS, allow_reuse=True)(_lower)
+
+    class Config:
+        validate_assignment = True
+
+    def sun_keys(self) -> Iterator[SunKeys]:
+        """
+        Key sets to verify taps with, by key version. The previous keys are
+        only prepared once the current ones did not verify the tap.
+        """
+        yield get_sun_keys(self.k1, self.k2, self.uid)
+        if self.rotating:
+            yield get_sun_keys(self.prev_k1, self.prev_k2, self.uid)
 
     def lnurl(self, req: Request) -> Lnurl:
         url = str(
@@ -53,6 +84,48 @@ class CreateCardData(BaseModel):
     prev_k1: str = Query(ZERO_KEY)
     prev_k2: str = Query(ZERO_KEY)
 
+    _normalize_uid = validator("uid", allow_reuse=True)(_upper)
+    _normalize_keys = validator(*KEYS, allow_reuse=True)(_lower)
+
+    class Config:
+        validate_assignment = True
+
+
+class CreateCardsData(BaseModel):
+    cards: list[CreateCardData] = Field([], max_items=5000)
+    # cards created from only a UID get random keys and the settings below
+    uids: list[str] = Field([], max_items=5000)
+    card_name: str = ""
+    tx_limit: int = 0
+    daily_limit: int = 0
+
+
+class ProvisionedCard(BaseModel):
+    card: Card
+    auth_link: str
+
+
+class SkippedCard(BaseModel):
+    uid: str
+    reason: str
+
+
+class CardsImportResult(BaseModel):
+    imported: int = 0
+    replaced: int = 0
+    skipped: list[SkippedCard] = []
+
+
+class RotateKeysData(BaseModel):
+    # random keys are generated for the ones not given
+    k0: str | None = None
+    k1: str | None = None
+    k2: str | None = None
+
+
+class DeleteCardsData(BaseModel):
+    ids: list[str] = Field(..., min_items=1, max_items=5000)
+
 
 class Hit(BaseModel):
     id: str
@@ -64,6 +137,7 @@ class Hit(BaseModel):
     new_ctr: int
     amount: int
     time: datetime
+    key_version: int = 0
 
 
 class Refund(BaseModel):
@@ -71,8 +145,35 @@ class Refund(BaseModel):
     hit_id: str
     refund_amount: int
     time: datetime
+    payment_hash: str | None = None
+
+
+class CardDailySpend(BaseModel):
+    card_id: str
+    day: str
+    spent_msat: int
+    tap_count: int
+    refund_total: int
 
 
 class UIDPost(BaseModel):
     UID: str | None = Field(None, description="The UID of the card.")
     LNURLW: str | None = Field(None, description="The LNURLW of the card.")
+
+
+class SunTap(BaseModel):
+    external_id: str
+    p: str
+    c: str
+
+
+class BatchVerifyData(BaseModel):
+    taps: list[SunTap] = Field(..., max_items=5000)
+
+
+class SunVerdict(BaseModel):
+    external_id: str
+    p: str
+    valid: bool
+    counter: int | None = None
+    reason: str | None = None
@@ -1,9 +1,13 @@
 # https://www.nxp.com/docs/en/application-note/AN12196.pdf
 
+from functools import lru_cache
+
 from Cryptodome.Cipher import AES
 from Cryptodome.Hash import CMAC
 
 SV2 = "3CC300010080"
+SV2_BYTES = bytes.fromhex(SV2)
+ZERO_IV = b"\x00" * 16
 
 
 def my_cmac(key: bytes, msg: bytes = b"") -> bytes:
@@ -14,9 +18,7 @@ def my_cmac(key: bytes, msg: bytes = b"") -> bytes:
 
 
 def decrypt_sun(sun: bytes, key: bytes) -> tuple[bytes, bytes]:
-    ivbytes = b"\x00" * 16
-
-    cipher = AES.new(key, AES.MODE_CBC, ivbytes)
+    cipher = AES.new(key, AES.MODE_CBC, ZERO_IV)
     sun_plain = cipher.decrypt(sun)
 
     uid = sun_plain[1:8]
@@ -26,10 +28,43 @@ def decrypt_sun(sun: bytes, key: bytes) -> tuple[bytes, bytes]:
 
 
 def get_sun_mac(uid: bytes, counter: bytes, key: bytes) -> bytes:
-    sv2prefix = bytes.fromhex(SV2)
-    sv2bytes = sv2prefix + uid + counter
+    sv2bytes = SV2_BYTES + uid + counter
 
     mac1 = my_cmac(key, sv2bytes)
     mac2 = my_cmac(mac1)
 
     return mac2[1::2]
+
+
+class SunKeys:
+    """
+    Decoded k1/k2 of a card with the cipher state that can be reused across
+    taps: the AES key schedule for k1 and the CMAC subkeys for k2. `uid` is
+    the decoded UID the card is registered with, to compare decrypted UIDs to.
+    """
+
+    def __init__(self, k1: bytes, k2: bytes, uid: bytes = b""):
+        self.k1 = k1
+        self.k2 = k2
+        self.uid = uid
+        # a single block CBC decrypt with a zero IV is a plain ECB decrypt
+        self._k1_ecb = AES.new(k1, AES.MODE_ECB)
+        self._k2_cmac = CMAC.new(k2, ciphermod=AES)
+
+    def decrypt_sun(self, sun: bytes) -> tuple[bytes, bytes]:
+        if len(sun) != 16:
+            return decrypt_sun(sun, self.k1)
+        sun_plain = self._k1_ecb.decrypt(sun)
+        return sun_plain[1:8], sun_plain[8:11]
+
+    def get_sun_mac(self, uid: bytes, counter: bytes) -> bytes:
+        cobj = self._k2_cmac.copy()
+        cobj.update(SV2_BYTES + uid + counter)
+        mac2 = my_cmac(cobj.digest())
+        return mac2[1::2]
+
+
+@lru_cache(maxsize=1024)
+def get_sun_keys(k1: str, k2: str, uid: str = "") -> SunKeys:
+    """Prepared keys for a card, cached by the hex keys and UID themselves."""
+    return SunKeys(bytes.fromhex(k1), bytes.fromhex(k2), bytes.fromhex(uid))
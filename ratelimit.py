@@ -0,0 +1,34 @@
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    """
+    In-process token buckets, one per key. Each bucket holds up to `burst`
+    tokens and refills at `rate` tokens per second, a request takes one token.
+    Only the `maxsize` most recently used keys are tracked, a `rate` of 0
+    disables the limiter.
+    """
+
+    def __init__(self, rate: float, burst: int, maxsize: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def allow(self, key: str) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    def clear(self) -> None:
+        self._buckets.clear()
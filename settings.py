@@ -0,0 +1,32 @@
+from pydantic import BaseSettings
+
+
+class BoltcardsSettings(BaseSettings):
+    """Operator settings, read from `BOLTCARDS_*` environment variables."""
+
+    # concurrent refund processing, payments of one hit stay in order
+    payment_workers: int = 4
+    payment_queue_size: int = 1000
+    # refunds arriving within this many seconds are recorded together
+    payment_batch_window: float = 0.05
+    payment_batch_size: int = 100
+    # archive and delete hits older than this many days, 0 keeps them forever
+    hits_retention_days: int = 0
+    retention_interval_seconds: int = 3600
+    retention_batch_size: int = 500
+    # defaults to `<lnbits data folder>/boltcards_archive`
+    archive_folder: str | None = None
+    # scans allowed per second and burst size, per card and per client ip,
+    # a rate of 0 disables the limit
+    scan_rate_per_card: float = 1.0
+    scan_burst_per_card: int = 5
+    scan_rate_per_ip: float = 5.0
+    scan_burst_per_ip: int = 20
+    # log a stage breakdown of LNURL requests slower than this, 0 disables it
+    slow_request_ms: float = 0
+
+    class Config:
+        env_prefix = "BOLTCARDS_"
+
+
+boltcards_settings = BoltcardsSettings()
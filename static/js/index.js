@@ -1,3 +1,5 @@
+const PAGE_SIZE = 500
+
 const mapCards = obj => {
   obj.date = Quasar.date.formatDate(new Date(obj.time), 'YYYY-MM-DD HH:mm')
   return obj
@@ -13,7 +15,9 @@ window.app = Vue.createApp({
       lnurlLink: `${window.location.host}/boltcards/api/v1/scan/`,
       cards: [],
       hits: [],
+      hitsCursor: null,
       refunds: [],
+      refundsCursor: null,
       cardDialog: {
         show: false,
         data: {
@@ -206,31 +210,37 @@ window.app = Vue.createApp({
           this.getHits()
         })
     },
-    getHits() {
+    getHits(more = false) {
+      const cursor = more ? `&cursor=${this.hitsCursor}` : ''
       LNbits.api
         .request(
           'GET',
-          '/boltcards/api/v1/hits?all_wallets=true',
+          `/boltcards/api/v1/hits?all_wallets=true&limit=${PAGE_SIZE}${cursor}`,
           this.g.user.wallets[0].inkey
         )
         .then(response => {
-          this.hits = response.data.map(obj => {
+          const hits = response.data.map(obj => {
             obj.card_name = this.cards.find(d => d.id == obj.card_id).card_name
             return mapCards(obj)
           })
+          this.hits = more ? this.hits.concat(hits) : hits
+          this.hitsCursor = response.headers['x-next-cursor'] || null
         })
     },
-    getRefunds() {
+    getRefunds(more = false) {
+      const cursor = more ? `&cursor=${this.refundsCursor}` : ''
       LNbits.api
         .request(
           'GET',
-          '/boltcards/api/v1/refunds?all_wallets=true',
+          `/boltcards/api/v1/refunds?all_wallets=true&limit=${PAGE_SIZE}${cursor}`,
           this.g.user.wallets[0].inkey
         )
         .then(response => {
-          this.refunds = response.data.map(obj => {
+          const refunds = response.data.map(obj => {
             return mapCards(obj)
           })
+          this.refunds = more ? this.refunds.concat(refunds) : refunds
+          this.refundsCursor = response.headers['x-next-cursor'] || null
         })
     },
     openQrCodeDialog(cardId, wipe) {
@@ -250,13 +260,17 @@ window.app = Vue.createApp({
         k3: card.k1,
         k4: card.k2
       }
+      // until it taps with the rotated keys the card still holds the previous ones
+      const keys = card.rotating
+        ? [card.prev_k0, card.prev_k1, card.prev_k2]
+        : [card.k0, card.k1, card.k2]
       this.qrCodeDialog.data_wipe = JSON.stringify({
         action: 'wipe',
-        k0: card.k0,
-        k1: card.k1,
-        k2: card.k2,
-        k3: card.k1,
-        k4: card.k2,
+        k0: keys[0],
+        k1: keys[1],
+        k2: keys[2],
+        k3: keys[1],
+        k4: keys[2],
         uid: card.uid,
         version: 1
       })
@@ -408,10 +422,23 @@ window.app = Vue.createApp({
       LNbits.utils.exportCSV(this.cardsTable.columns, this.cards)
     },
     exportHitsCSV() {
-      LNbits.utils.exportCSV(this.hitsTable.columns, this.hits)
+      this.downloadExport('hits')
     },
     exportRefundsCSV() {
-      LNbits.utils.exportCSV(this.refundsTable.columns, this.refunds)
+      this.downloadExport('refunds')
+    },
+    downloadExport(kind) {
+      // the tables only hold the pages loaded so far, export all rows
+      LNbits.api
+        .request(
+          'GET',
+          `/boltcards/api/v1/export/${kind}?all_wallets=true&format=csv`,
+          this.g.user.wallets[0].inkey
+        )
+        .then(response => {
+          Quasar.exportFile(`${kind}.csv`, response.data, 'text/csv')
+        })
+        .catch(LNbits.utils.notifyApiError)
     }
   },
   created() {
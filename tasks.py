@@ -1,33 +1,209 @@
 import asyncio
+import gzip
+import os
+import time
+from datetime import datetime, timedelta, timezone
 
 from lnbits.core.crud import update_payment
+from lnbits.core.db import db as core_db
 from lnbits.core.models import Payment
+from lnbits.settings import settings
 from lnbits.tasks import register_invoice_listener
+from loguru import logger
+from pydantic import BaseModel
 
-from .crud import create_refund, get_hit
+from .crud import (
+    add_card_daily_spend,
+    create_refunds,
+    delete_hits,
+    get_hits_before,
+    get_hits_by_ids,
+    get_refunds,
+)
+from .metrics import errors_total, refunds_total, stage
+from .settings import boltcards_settings
+
+
+class PaymentQueueStats:
+    def __init__(self):
+        self.queues: list[asyncio.Queue] = []
+        self.workers = 0
+        self.processed = 0
+        self.batches = 0
+        self.failed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float, count: int = 1, failed: int = 0) -> None:
+        self.processed += count
+        self.batches += 1
+        self.failed += failed
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_depth": sum(queue.qsize() for queue in self.queues),
+            "processed": self.processed,
+            "batches": self.batches,
+            "failed": self.failed,
+            "avg_batch_seconds": (
+                self.total_seconds / self.batches if self.batches else 0
+            ),
+            "max_batch_seconds": self.max_seconds,
+        }
+
+
+payment_queue_stats = PaymentQueueStats()
 
 
 async def wait_for_paid_invoices():
-    invoice_queue = asyncio.Queue()
+    invoice_queue: asyncio.Queue = asyncio.Queue()
     register_invoice_listener(invoice_queue, "ext_boltcards")
 
-    while True:
-        payment = await invoice_queue.get()
-        await on_invoice_paid(payment)
+    # payments of the same hit always go to the same worker, which keeps
+    # them in order while unrelated payments are processed concurrently
+    worker_queues: list[asyncio.Queue] = [
+        asyncio.Queue(maxsize=boltcards_settings.payment_queue_size)
+        for _ in range(max(1, boltcards_settings.payment_workers))
+    ]
+    payment_queue_stats.queues = [invoice_queue, *worker_queues]
+    payment_queue_stats.workers = len(worker_queues)
+    workers = [asyncio.create_task(_payment_worker(queue)) for queue in worker_queues]
+    try:
+        while True:
+            payment = await invoice_queue.get()
+            key = str((payment.extra or {}).get("refund") or payment.payment_hash)
+            await worker_queues[hash(key) % len(worker_queues)].put(payment)
+    finally:
+        for worker in workers:
+            worker.cancel()
 
 
-async def on_invoice_paid(payment: Payment) -> None:
+async def _payment_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        payments = [await queue.get()]
+        # coalesce payments arriving shortly after each other into one batch
+        deadline = loop.time() + boltcards_settings.payment_batch_window
+        while len(payments) < boltcards_settings.payment_batch_size:
+            try:
+                payment = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            payments.append(payment)
+        start = time.perf_counter()
+        failed = 0
+        try:
+            with stage("refund_batch"):
+                await on_invoices_paid(payments)
+        except Exception as exc:
+            errors_total.inc(endpoint="payment_worker", reason=type(exc).__name__)
+            logger.warning(
+                f"boltcards: failed to process {len(payments)} refunds together, "
+                f"retrying them one by one: {exc}"
+            )
+            # refunds are recorded once per payment hash, so the payments of
+            # the batch that did go through are not recorded twice
+            for payment in payments:
+                try:
+                    await on_invoices_paid([payment])
+                except Exception as error:
+                    failed += 1
+                    logger.error(
+                        "boltcards: failed to process refund "
+                        f"{payment.payment_hash}: {error}"
+                    )
+        payment_queue_stats.record(time.perf_counter() - start, len(payments), failed)
 
-    if not payment.extra or not payment.extra.get("refund"):
-        return
 
-    if payment.extra.get("wh_status"):
+async def on_invoices_paid(payments: list[Payment]) -> None:
+    payments = [
+        payment
+        for payment in payments
+        if payment.extra and payment.extra.get("refund")
         # this webhook has already been sent
+        and not payment.extra.get("wh_status")
+    ]
+    if not payments:
         return
 
-    hit = await get_hit(str(payment.extra.get("refund")))
+    hits = {
+        hit.id: hit
+        for hit in await get_hits_by_ids(
+            [str(payment.extra["refund"]) for payment in payments]
+        )
+    }
+    payments = [payment for payment in payments if str(payment.extra["refund"]) in hits]
+    refunds = await create_refunds(
+        [
+            (str(payment.extra["refund"]), payment.amount // 1000, payment.payment_hash)
+            for payment in payments
+        ]
+    )
+
+    daily: dict[str, int] = {}
+    for refund in refunds:
+        card_id = hits[refund.hit_id].card_id
+        daily[card_id] = daily.get(card_id, 0) + refund.refund_amount * 1000
+    for card_id, refund_total in daily.items():
+        await add_card_daily_spend(
+            card_id, datetime.now(timezone.utc), refund_total=refund_total
+        )
 
-    if hit:
-        await create_refund(hit_id=hit.id, refund_amount=(payment.amount / 1000))
-        payment.extra["wh_status"] = 1
-        await update_payment(payment)
+    async with core_db.connect() as conn:
+        for payment in payments:
+            payment.extra["wh_status"] = 1
+            await update_payment(payment, conn=conn)
+    refunds_total.inc(len(refunds))
+
+
+async def purge_old_hits():
+    while True:
+        if boltcards_settings.hits_retention_days > 0:
+            cutoff = datetime.now(timezone.utc) - timedelta(
+                days=boltcards_settings.hits_retention_days
+            )
+            archived = await archive_hits(cutoff)
+            if archived:
+                logger.info(f"boltcards: archived {archived} hits before {cutoff}")
+        await asyncio.sleep(boltcards_settings.retention_interval_seconds)
+
+
+async def archive_hits(cutoff: datetime) -> int:
+    """
+    Move hits older than `cutoff` and their refunds to gzipped NDJSON files,
+    in batches so no statement holds the database for long. Daily totals stay
+    available in `card_daily_spend`. Rows are written to the archive before
+    they are deleted, an interrupted run can only duplicate archive lines.
+    """
+    folder = boltcards_settings.archive_folder or os.path.join(
+        settings.lnbits_data_folder, "boltcards_archive"
+    )
+    day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    archived = 0
+    while True:
+        hits = await get_hits_before(cutoff, boltcards_settings.retention_batch_size)
+        if not hits:
+            return archived
+        hits_ids = [hit.id for hit in hits]
+        refunds = await get_refunds(hits_ids)
+        await asyncio.to_thread(
+            _append_ndjson, os.path.join(folder, f"hits-{day}.ndjson.gz"), hits
+        )
+        await asyncio.to_thread(
+            _append_ndjson, os.path.join(folder, f"refunds-{day}.ndjson.gz"), refunds
+        )
+        await delete_hits(hits_ids)
+        archived += len(hits)
+
+
+def _append_ndjson(path: str, rows: list[BaseModel]) -> None:
+    if not rows:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # appending creates a new gzip member, readers decompress them as one stream
+    with gzip.open(path, "at", encoding="utf-8") as file:
+        for row in rows:
+            file.write(f"{row.json()}\n")
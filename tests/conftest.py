@@ -0,0 +1,54 @@
+import re
+
+import pytest
+import pytest_asyncio
+from lnbits.db import SQLITE
+
+from .. import migrations
+from ..crud import card_cache, db, uid_map
+from ..views_lnurl import card_limiter, ip_limiter
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark", action="store_true", help="run the tap flow benchmarks"
+    )
+    parser.addoption(
+        "--benchmark-hits",
+        type=int,
+        default=100_000,
+        help="hits seeded by the large benchmarks, the index benchmark of m003 "
+        "and m004 was specified with 1000000",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="needs --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest_asyncio.fixture
+async def migrated_db(tmp_path):
+    """
+    Fresh boltcards schema for every test. On sqlite the schema lives in a
+    temporary file, on postgres the configured database must be disposable.
+    """
+    if db.type == SQLITE:
+        db.path = str(tmp_path / "ext_boltcards.sqlite3")
+    else:
+        await db.execute("DROP SCHEMA IF EXISTS boltcards CASCADE")
+    async with db.connect() as conn:
+        for key, migrate in migrations.__dict__.items():
+            if re.match(r"^m\d{3}_", key):
+                await migrate(conn)
+    card_cache.clear()
+    uid_map.clear()
+    card_limiter.clear()
+    ip_limiter.clear()
+    yield db
+    card_cache.clear()
+    uid_map.clear()
@@ -0,0 +1,98 @@
+import secrets
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from bolt11 import Bolt11, MilliSatoshi, TagChar, Tags, encode
+from Cryptodome.Cipher import AES
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+from lnbits.decorators import require_admin_key, require_invoice_key
+
+from .. import boltcards_ext
+from ..crud import create_card, db
+from ..models import Card, CreateCardData
+from ..nxp424 import get_sun_mac
+
+
+async def create_test_card(wallet_id: str = "wallet", **kwargs) -> Card:
+    data = CreateCardData(
+        card_name="test",
+        uid=secrets.token_hex(7),
+        k0=secrets.token_hex(16),
+        k1=secrets.token_hex(16),
+        k2=secrets.token_hex(16),
+        tx_limit=1000,
+        daily_limit=10000,
+    )
+    for key, value in kwargs.items():
+        setattr(data, key, value)
+    return await create_card(data, wallet_id)
+
+
+def sun_params(card: Card, counter: int) -> dict[str, str]:
+    """`p` and `c` query params as a card would write them on tap."""
+    uid = bytes.fromhex(card.uid)
+    ctr = counter.to_bytes(3, "little")
+    plain = b"\xc7" + uid + ctr + secrets.token_bytes(5)
+    cipher = AES.new(bytes.fromhex(card.k1), AES.MODE_CBC, b"\x00" * 16)
+    p = cipher.encrypt(plain).hex().upper()
+    c = get_sun_mac(uid, ctr, bytes.fromhex(card.k2)).hex().upper()
+    return {"p": p, "c": c}
+
+
+def lnurl_client() -> AsyncClient:
+    app = FastAPI()
+    app.include_router(boltcards_ext)
+    return AsyncClient(
+        transport=ASGITransport(app=app, raise_app_exceptions=False),
+        base_url="http://localhost",
+    )
+
+
+def api_client(wallet_id: str = "wallet") -> AsyncClient:
+    """Client for the extension api, authenticated with the keys of `wallet_id`."""
+    app = FastAPI()
+    app.include_router(boltcards_ext)
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id=wallet_id, user="user"))
+    app.dependency_overrides[require_admin_key] = lambda: key_info
+    app.dependency_overrides[require_invoice_key] = lambda: key_info
+    return AsyncClient(transport=ASGITransport(app=app), base_url="http://localhost")
+
+
+def create_test_invoice(amount_sat: int) -> str:
+    tags = Tags()
+    tags.add(TagChar.description, "boltcards test")
+    tags.add(TagChar.payment_secret, secrets.token_hex(32))
+    tags.add(TagChar.payment_hash, secrets.token_hex(32))
+    invoice = Bolt11(
+        currency="bc",
+        amount_msat=MilliSatoshi(amount_sat * 1000),
+        date=int(time.time()),
+        tags=tags,
+    )
+    return encode(invoice, secrets.token_hex(32))
+
+
+async def insert_rows(table: str, rows: list[dict], chunk_size: int = 500) -> None:
+    """Multi-row inserts of `rows`, which all have the same columns, as given."""
+    columns = list(rows[0])
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start : start + chunk_size]
+        values: dict = {}
+        placeholders = []
+        for i, row in enumerate(chunk):
+            names = []
+            for column in columns:
+                name = f"{column}_{i}"
+                values[name] = row[column]
+                if isinstance(row[column], datetime):
+                    names.append(db.timestamp_placeholder(name))
+                else:
+                    names.append(f":{name}")
+            placeholders.append(f"({', '.join(names)})")
+        await db.execute(
+            f"INSERT INTO boltcards.{table} ({', '.join(columns)}) "
+            f"VALUES {', '.join(placeholders)}",
+            values,
+        )
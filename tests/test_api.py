@@ -0,0 +1,292 @@
+import csv
+import io
+import json
+import secrets
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from lnbits.helpers import urlsafe_short_hash
+
+from ..crud import (
+    create_refunds,
+    delete_cards,
+    get_card,
+    get_card_by_otp,
+    get_cards,
+    get_hits,
+    update_card,
+    update_card_counter,
+)
+from .helpers import api_client, create_test_card, insert_rows, sun_params
+
+
+@pytest.mark.asyncio
+async def test_bulk_provisioning(migrated_db):
+    uids = [secrets.token_hex(7) for _ in range(3)]
+    data = {
+        "cards": [
+            {
+                "card_name": "given keys",
+                "uid": uids[0],
+                "k0": secrets.token_hex(16),
+                "k1": secrets.token_hex(16),
+                "k2": secrets.token_hex(16),
+            }
+        ],
+        "uids": uids[1:],
+        "tx_limit": 100,
+        "daily_limit": 1000,
+    }
+    async with api_client() as client:
+        res = await client.post("/boltcards/api/v1/cards/bulk", json=data)
+    assert res.status_code == 201
+    provisioned = res.json()
+    assert [p["card"]["uid"] for p in provisioned] == [uid.upper() for uid in uids]
+    assert provisioned[0]["card"]["k1"] == data["cards"][0]["k1"]
+    assert provisioned[1]["card"]["k1"] != provisioned[2]["card"]["k1"]
+    assert provisioned[2]["card"]["tx_limit"] == 100
+    otp = provisioned[1]["auth_link"].split("/boltcards/api/v1/auth?a=")[1]
+    card = await get_card_by_otp(otp)
+    assert card
+    assert card.uid == uids[1].upper()
+    assert len(await get_cards(["wallet"])) == 3
+
+
+@pytest.mark.asyncio
+async def test_bulk_provisioning_rejects_duplicate_uids(migrated_db):
+    registered = await create_test_card()
+    new = secrets.token_hex(7)
+    async with api_client() as client:
+        url = "/boltcards/api/v1/cards/bulk"
+        repeated = await client.post(url, json={"uids": [new, new.upper()]})
+        taken = await client.post(url, json={"uids": [new, registered.uid]})
+        invalid = await client.post(url, json={"uids": [new, "00"]})
+    assert repeated.status_code == 400
+    assert taken.status_code == 400
+    assert registered.uid in taken.json()["detail"]
+    assert invalid.json()["detail"] == "Card 1: Invalid byte data provided."
+    assert await get_cards(["wallet"]) == [registered]
+
+
+@pytest.mark.asyncio
+async def test_card_archive_round_trip(migrated_db):
+    cards = [await create_test_card("source") for _ in range(3)]
+    for card in cards:
+        card.prev_k1 = "11" * 16
+        await update_card(card)
+    headers = {"x-archive-passphrase": "correct horse"}
+    async with api_client("source") as client:
+        res = await client.get("/boltcards/api/v1/cards/export", headers=headers)
+    assert res.status_code == 200
+    archive = res.content
+    await delete_cards([card.id for card in cards[1:]])
+
+    url = "/boltcards/api/v1/cards/import"
+    async with api_client("target") as client:
+        imported = await client.post(url, content=archive, headers=headers)
+        again = await client.post(
+            f"{url}?on_conflict=replace", content=archive, headers=headers
+        )
+        wrong = await client.post(
+            url, content=archive, headers={"x-archive-passphrase": "wrong horse"}
+        )
+        truncated = await client.post(url, content=archive[:-10], headers=headers)
+
+    assert imported.json() == {
+        "imported": 2,
+        "replaced": 0,
+        "skipped": [{"uid": cards[0].uid, "reason": "UID already registered."}],
+    }
+    assert again.json() == {
+        "imported": 0,
+        "replaced": 2,
+        "skipped": [
+            {"uid": cards[0].uid, "reason": "UID registered in another wallet."}
+        ],
+    }
+    assert wrong.status_code == 400
+    assert truncated.status_code == 400
+    moved = {card.uid: card for card in await get_cards(["target"])}
+    for card in cards[1:]:
+        assert moved[card.uid].external_id == card.external_id
+        assert moved[card.uid].k1 == card.k1
+        assert moved[card.uid].prev_k1 == "11" * 16
+
+
+@pytest.mark.asyncio
+async def test_card_import_replace_keeps_counter(migrated_db):
+    card = await create_test_card(counter=5)
+    headers = {"x-archive-passphrase": "correct horse"}
+    async with api_client() as client:
+        archive = (
+            await client.get("/boltcards/api/v1/cards/export", headers=headers)
+        ).content
+        await update_card_counter(9, card.id)
+        res = await client.post(
+            "/boltcards/api/v1/cards/import?on_conflict=replace",
+            content=archive,
+            headers=headers,
+        )
+    assert res.json()["replaced"] == 1
+    (replaced,) = await get_cards(["wallet"])
+    assert replaced.id == card.id
+    assert replaced.counter == 9
+
+
+@pytest.mark.asyncio
+async def test_verify_taps(migrated_db):
+    card = await create_test_card(counter=2)
+    foreign = await create_test_card("other wallet")
+
+    def tap(card, counter):
+        return {"external_id": card.external_id, **sun_params(card, counter)}
+
+    taps = [
+        tap(card, 5),
+        tap(card, 3),
+        tap(card, 5),
+        tap(card, 1),
+        tap(foreign, 1),
+        {**tap(card, 7), "c": "00" * 8},
+    ]
+    async with api_client() as client:
+        res = await client.post("/boltcards/api/v1/verify", json={"taps": taps})
+        replayed = await client.post("/boltcards/api/v1/verify", json={"taps": taps})
+    assert res.status_code == 200
+    # out of order taps are accepted in counter order, replays in the batch not
+    assert [(v["valid"], v["reason"]) for v in res.json()] == [
+        (True, None),
+        (True, None),
+        (False, "This link is already used."),
+        (False, "This link is already used."),
+        (False, "Card not found."),
+        (False, "CMAC does not check."),
+    ]
+    assert [v["counter"] for v in res.json()[:2]] == [5, 3]
+    assert not any(v["valid"] for v in replayed.json())
+    updated = await get_card(card.id)
+    assert updated
+    assert updated.counter == 5
+    untouched = await get_card(foreign.id)
+    assert untouched
+    assert untouched.counter == 0
+
+
+async def _insert_hits(card_id: str, times: list[datetime]) -> None:
+    await insert_rows(
+        "hits",
+        [
+            {
+                "id": urlsafe_short_hash(),
+                "card_id": card_id,
+                "ip": "127.0.0.1",
+                "spent": True,
+                "useragent": "test",
+                "old_ctr": 0,
+                "new_ctr": 0,
+                "amount": 1,
+                "time": time,
+            }
+            for time in times
+        ],
+    )
+
+
+async def _pages(client, url: str, limit: int, **params) -> list[list[str]]:
+    pages: list[list[str]] = []
+    cursor = None
+    while True:
+        if cursor:
+            params["cursor"] = cursor
+        res = await client.get(url, params={**params, "limit": limit})
+        assert res.status_code == 200
+        pages.append([row["id"] for row in res.json()])
+        cursor = res.headers.get("x-next-cursor")
+        if not cursor:
+            return pages
+
+
+def _flat(pages: list[list[str]]) -> list[str]:
+    return [item for page in pages for item in page]
+
+
+@pytest.mark.asyncio
+async def test_hits_keyset_pagination(migrated_db):
+    card, other = await create_test_card(), await create_test_card()
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    yesterday = now - timedelta(days=1)
+    await _insert_hits(card.id, [now] * 5 + [yesterday] * 2)
+    await _insert_hits(other.id, [now])
+    url = "/boltcards/api/v1/hits"
+    async with api_client() as client:
+        everything = (await client.get(url)).json()
+        pages = await _pages(client, url, 2)
+        since = await _pages(
+            client, url, 2, since=(now - timedelta(hours=1)).isoformat()
+        )
+        until = await _pages(
+            client, url, 2, until=(now - timedelta(hours=1)).isoformat()
+        )
+        by_card = await _pages(client, url, 2, card_id=other.id)
+        invalid = await client.get(url, params={"cursor": "yesterday"})
+
+    # newest first, rows with the same time ordered by id
+    assert [(h["time"], h["id"]) for h in everything] == sorted(
+        [(h["time"], h["id"]) for h in everything], reverse=True
+    )
+    assert [len(page) for page in pages] == [2, 2, 2, 2, 0]
+    assert _flat(pages) == [hit["id"] for hit in everything]
+    assert len(_flat(since)) == 6
+    assert _flat(until) == [h["id"] for h in everything if h["card_id"] == card.id][5:]
+    assert by_card == [[h["id"] for h in everything if h["card_id"] == other.id]]
+    assert invalid.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_refunds_keyset_pagination(migrated_db):
+    card = await create_test_card()
+    await _insert_hits(card.id, [datetime.now(timezone.utc)])
+    (hit,) = await get_hits([card.id])
+    await create_refunds([(hit.id, 1, f"hash{i}") for i in range(5)])
+    url = "/boltcards/api/v1/refunds"
+    async with api_client() as client:
+        everything = (await client.get(url)).json()
+        pages = await _pages(client, url, 2, card_id=card.id)
+    assert len(everything) == 5
+    assert _flat(pages) == [refund["id"] for refund in everything]
+
+
+@pytest.mark.asyncio
+async def test_export_streams_all_chunks(migrated_db):
+    card = await create_test_card()
+    other = await create_test_card("other wallet")
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    # more than one 1000 row chunk, with ties on time across the chunk border
+    await _insert_hits(card.id, [now - timedelta(minutes=i // 10) for i in range(2500)])
+    await _insert_hits(other.id, [now])
+    url = "/boltcards/api/v1/export/hits"
+    async with api_client() as client:
+        ndjson = await client.get(url)
+        csv_export = await client.get(url, params={"format": "csv"})
+        since = await client.get(
+            url, params={"since": (now - timedelta(minutes=10)).isoformat()}
+        )
+        refunds = await client.get(
+            "/boltcards/api/v1/export/refunds", params={"format": "csv"}
+        )
+
+    assert ndjson.headers["content-type"] == "application/x-ndjson"
+    hits = [json.loads(line) for line in ndjson.text.splitlines()]
+    assert len(hits) == 2500
+    assert len({hit["id"] for hit in hits}) == 2500
+    assert {hit["card_id"] for hit in hits} == {card.id}
+    assert [(h["time"], h["id"]) for h in hits] == sorted(
+        [(h["time"], h["id"]) for h in hits], reverse=True
+    )
+
+    assert csv_export.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(csv_export.text)))
+    assert [row["id"] for row in rows] == [hit["id"] for hit in hits]
+    assert rows[0]["card_id"] == card.id
+    assert len(since.text.splitlines()) == 110
+    assert refunds.text.splitlines() == ["id,hit_id,refund_amount,time,payment_hash"]
@@ -0,0 +1,183 @@
+"""
+Benchmarks of the LNURL tap flow, skipped unless pytest runs with `--benchmark`.
+`--benchmark-hits` sets the number of hits seeded for the large benchmarks.
+Set `LNBITS_DATABASE_URL` to a disposable postgres database to run them
+against postgres instead of sqlite.
+"""
+
+import asyncio
+import random
+import secrets
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from lnbits.helpers import urlsafe_short_hash
+
+from .. import views_lnurl
+from ..crud import db, get_card_by_otp, get_cards, get_hits, get_refunds
+from ..models import Card
+from .helpers import create_test_invoice, insert_rows, lnurl_client, sun_params
+
+pytestmark = pytest.mark.benchmark
+
+TAPS = 200
+CONCURRENCY = 16
+INDEXES = [
+    "hits_card_id_time_idx",
+    "refunds_hit_id_idx",
+    "cards_wallet_idx",
+    "cards_otp_idx",
+]
+
+
+async def _seed(cards: int, hits: int) -> list[Card]:
+    """`cards` cards with random keys and `hits` spent hits spread over them."""
+    await insert_rows(
+        "cards",
+        [
+            {
+                "id": urlsafe_short_hash().upper(),
+                "uid": secrets.token_hex(7).upper(),
+                "external_id": urlsafe_short_hash().lower(),
+                "wallet": f"wallet{i % 10}",
+                "card_name": f"card {i}",
+                "counter": 0,
+                "tx_limit": 1000,
+                "daily_limit": 1_000_000,
+                "enable": True,
+                "k0": secrets.token_hex(16),
+                "k1": secrets.token_hex(16),
+                "k2": secrets.token_hex(16),
+                "otp": secrets.token_hex(16),
+            }
+            for i in range(cards)
+        ],
+    )
+    seeded = await get_cards([f"wallet{i}" for i in range(10)])
+    if hits:
+        now = datetime.now(timezone.utc)
+        await insert_rows(
+            "hits",
+            [
+                {
+                    "id": urlsafe_short_hash(),
+                    "card_id": seeded[i % len(seeded)].id,
+                    "ip": "127.0.0.1",
+                    "spent": True,
+                    "useragent": "benchmark",
+                    "old_ctr": 0,
+                    "new_ctr": 0,
+                    "amount": 1,
+                    "time": now - timedelta(minutes=i % 43200),
+                }
+                for i in range(hits)
+            ],
+        )
+    return seeded
+
+
+@pytest.fixture
+def benchmark_hits(request) -> int:
+    return request.config.getoption("--benchmark-hits")
+
+
+def _report(name: str, latencies: list[float], per_sec: float) -> float:
+    """Print p50/p99 and throughput, returns the p50 latency."""
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"\n{name} [{db.type}]: p50 {percentiles[49] * 1000:.2f}ms, "
+        f"p99 {percentiles[98] * 1000:.2f}ms, {per_sec:.0f}/s"
+    )
+    return percentiles[49]
+
+
+async def _tap(client, card: Card, counter: int, invoice: str) -> tuple[float, float]:
+    start = time.perf_counter()
+    res = await client.get(
+        f"/boltcards/api/v1/scan/{card.external_id}", params=sun_params(card, counter)
+    )
+    scanned = time.perf_counter()
+    assert res.status_code == 200
+    assert res.json()["tag"] == "withdrawRequest"
+    hit_id = res.json()["k1"]
+    called = time.perf_counter()
+    res = await client.get(
+        f"/boltcards/api/v1/lnurl/cb/{hit_id}", params={"k1": hit_id, "pr": invoice}
+    )
+    assert res.json()["status"] == "OK"
+    return scanned - start, time.perf_counter() - called
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "cards, hits", [(100, 1_000), (10_000, None)], ids=["small", "large"]
+)
+async def test_tap_flow(migrated_db, monkeypatch, benchmark_hits, cards, hits):
+    hits = hits or benchmark_hits
+
+    async def fake_pay_invoice(**kwargs):
+        await asyncio.sleep(0)
+
+    monkeypatch.setattr(views_lnurl, "pay_invoice", fake_pay_invoice)
+    monkeypatch.setattr(views_lnurl.card_limiter, "rate", 0)
+    monkeypatch.setattr(views_lnurl.ip_limiter, "rate", 0)
+    seeded = await _seed(cards, hits)
+    counters = {card.id: 0 for card in seeded}
+    invoices = [create_test_invoice(1) for _ in range(TAPS)]
+
+    async def tap(card: Card, invoice: str) -> tuple[float, float]:
+        counters[card.id] += 1
+        return await _tap(client, card, counters[card.id], invoice)
+
+    async with lnurl_client() as client:
+        start = time.perf_counter()
+        timings = [await tap(random.choice(seeded), invoice) for invoice in invoices]
+        sequential = TAPS / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for offset in range(0, TAPS, CONCURRENCY):
+            batch = random.sample(seeded, CONCURRENCY)
+            await asyncio.gather(
+                *[
+                    tap(card, invoice)
+                    for card, invoice in zip(
+                        batch, invoices[offset : offset + CONCURRENCY], strict=False
+                    )
+                ]
+            )
+        concurrent = TAPS / (time.perf_counter() - start)
+
+    name = f"{cards} cards, {hits} hits"
+    _report(f"scan, {name}", [scan for scan, _ in timings], sequential)
+    _report(f"callback, {name}", [callback for _, callback in timings], sequential)
+    _report(f"tap, {name}", [sum(timing) for timing in timings], sequential)
+    print(f"{name}: {concurrent:.0f} taps/s with {CONCURRENCY} concurrent taps")
+
+
+async def _lookups(name: str, cards: list[Card]) -> float:
+    latencies = []
+    start = time.perf_counter()
+    for card in cards:
+        lookup = time.perf_counter()
+        assert await get_card_by_otp(card.otp)
+        hits = await get_hits([card.id], limit=100)
+        await get_refunds([hit.id for hit in hits])
+        latencies.append(time.perf_counter() - lookup)
+    return _report(name, latencies, len(cards) / (time.perf_counter() - start))
+
+
+@pytest.mark.asyncio
+async def test_lookup_indexes(migrated_db, benchmark_hits):
+    """
+    Card, hit and refund lookups outside of the tap path, before and after
+    dropping the indexes of m003/m004.
+    """
+    seeded = await _seed(10_000, benchmark_hits)
+    cards = random.sample(seeded, TAPS)
+    indexed = await _lookups("lookups with indexes", cards)
+    for name in INDEXES:
+        await db.execute(f"DROP INDEX boltcards.{name}")
+    unindexed = await _lookups("lookups without indexes", cards)
+    assert indexed < unindexed
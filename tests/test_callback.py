@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from .. import views_lnurl
+from ..crud import create_hit, get_hit
+from .helpers import create_test_card, create_test_invoice, lnurl_client
+
+
+@pytest.mark.asyncio
+async def test_concurrent_callbacks_pay_once(migrated_db, monkeypatch):
+    payments = []
+
+    async def fake_pay_invoice(**kwargs):
+        await asyncio.sleep(0)
+        payments.append(kwargs)
+
+    monkeypatch.setattr(views_lnurl, "pay_invoice", fake_pay_invoice)
+    card = await create_test_card()
+    hit = await create_hit(card.id, "127.0.0.1", "test", 0, 1)
+
+    async with lnurl_client() as client:
+        url = f"/boltcards/api/v1/lnurl/cb/{hit.id}"
+        params = {"k1": hit.id, "pr": create_test_invoice(500)}
+        responses = await asyncio.gather(
+            *[client.get(url, params=params) for _ in range(100)]
+        )
+
+    statuses = [res.json()["status"] for res in responses]
+    assert statuses.count("OK") == 1
+    assert len(payments) == 1
+    spent = await get_hit(hit.id)
+    assert spent
+    assert spent.spent
+    assert spent.amount == 500
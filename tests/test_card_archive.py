@@ -0,0 +1,62 @@
+import secrets
+
+import pytest
+
+from ..card_archive import (
+    FRAME_SIZE,
+    MAX_ROW_SIZE,
+    ArchiveError,
+    read_archive,
+    write_archive,
+)
+
+
+async def _rows(count: int):
+    for i in range(count):
+        yield {"i": i, "key": secrets.token_hex(16)}
+
+
+async def _collect(chunks) -> bytes:
+    return b"".join([chunk async for chunk in chunks])
+
+
+async def _split(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+@pytest.mark.asyncio
+async def test_archive_round_trip_across_frames():
+    archive = await _collect(write_archive(_rows(5000), "passphrase"))
+    assert len(archive) > FRAME_SIZE
+    rows = [row async for row in read_archive(_split(archive, 1000), "passphrase")]
+    assert [row["i"] for row in rows] == list(range(5000))
+
+
+@pytest.mark.asyncio
+async def test_archive_rejects_tampering():
+    archive = await _collect(write_archive(_rows(5000), "passphrase"))
+    tampered = archive[:100] + bytes([archive[100] ^ 1]) + archive[101:]
+    for data, passphrase in ((archive, "other"), (tampered, "passphrase")):
+        with pytest.raises(ArchiveError):
+            [row async for row in read_archive(_split(data, 4096), passphrase)]
+
+
+async def _one_row(row: dict):
+    yield row
+
+
+@pytest.mark.asyncio
+async def test_archive_rejects_oversized_rows():
+    # compresses to a few KiB, but would decompress to 10 MiB in one piece
+    bomb = await _collect(write_archive(_one_row({"x": "a" * 10_000_000}), "pass"))
+    assert len(bomb) < FRAME_SIZE
+    with pytest.raises(ArchiveError, match="too large"):
+        [row async for row in read_archive(_split(bomb, 4096), "pass")]
+
+    over = await _collect(write_archive(_one_row({"x": "a" * MAX_ROW_SIZE}), "pass"))
+    with pytest.raises(ArchiveError, match="too large"):
+        [row async for row in read_archive(_split(over, 4096), "pass")]
+    row = {"x": "a" * (MAX_ROW_SIZE - 20)}
+    small = await _collect(write_archive(_one_row(row), "pass"))
+    assert [row async for row in read_archive(_split(small, 4096), "pass")] == [row]
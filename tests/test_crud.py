@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+from lnbits.db import SQLITE, Connection
+
+from .. import crud, migrations, views_lnurl
+from ..crud import (
+    card_cache,
+    create_hit,
+    create_refund,
+    db,
+    delete_card,
+    get_card,
+    get_card_by_uid,
+    get_card_refunds,
+    get_hit,
+    get_hits,
+    get_refund,
+    uid_map,
+    update_card,
+    warm_uid_map,
+)
+from .helpers import (
+    create_test_card,
+    create_test_invoice,
+    insert_rows,
+    lnurl_client,
+    sun_params,
+)
+
+
+@pytest.fixture
+def round_trips(monkeypatch):
+    """Statements sent to the database, not counting the connection setup."""
+    queries: list[str] = []
+    for name in ("execute", "fetchone", "fetchall"):
+        method = getattr(Connection, name)
+
+        def counted(self, query, *args, _method=method, **kwargs):
+            if not query.startswith(("ATTACH", "CREATE SCHEMA")):
+                queries.append(query)
+            return _method(self, query, *args, **kwargs)
+
+        monkeypatch.setattr(Connection, name, counted)
+    return queries
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, False])
+async def test_created_rows_match_stored_rows(migrated_db, monkeypatch, returning):
+    monkeypatch.setattr(crud, "_supports_returning", lambda: returning)
+    card = await create_test_card(card_name="<b>test</b>")
+    hit = await create_hit(card.id, "127.0.0.1", "<agent>", 0, 1)
+    refund = await create_refund(hit.id, 21)
+
+    card_cache.clear()
+    assert card == await get_card(card.id)
+    assert hit == await get_hit(hit.id)
+    assert refund == await get_refund(refund.id)
+
+
+@pytest.mark.asyncio
+async def test_create_is_one_round_trip(migrated_db, round_trips):
+    card = await create_test_card()
+    hit = await create_hit(card.id, "127.0.0.1", "test", 0, 1)
+    await create_refund(hit.id, 21)
+    assert len(round_trips) == 3
+
+
+@pytest.mark.asyncio
+async def test_round_trips_per_tap(migrated_db, round_trips, monkeypatch):
+    async def fake_pay_invoice(**kwargs):
+        await asyncio.sleep(0)
+
+    monkeypatch.setattr(views_lnurl, "pay_invoice", fake_pay_invoice)
+    card = await create_test_card()
+
+    async with lnurl_client() as client:
+        round_trips.clear()
+        await client.get(
+            f"/boltcards/api/v1/scan/{card.external_id}", params=sun_params(card, 1)
+        )
+        scan = len(round_trips)
+        (hit,) = await get_hits([card.id])
+
+        round_trips.clear()
+        await client.get(
+            f"/boltcards/api/v1/lnurl/cb/{hit.id}",
+            params={"k1": hit.id, "pr": create_test_invoice(500)},
+        )
+        callback = len(round_trips)
+
+    print(f"\nround trips per tap: scan {scan}, callback {callback}")
+    # counter update, spent today and the hit insert
+    assert scan == 3
+    # claiming the hit and the daily rollup
+    assert callback == 2
+
+
+@pytest.mark.asyncio
+async def test_uid_lookups(migrated_db, round_trips):
+    cards = [await create_test_card() for _ in range(3)]
+    uid_map.clear()
+    card_cache.clear()
+    assert await warm_uid_map() == 3
+
+    round_trips.clear()
+    assert await get_card_by_uid(cards[0].uid.lower()) == cards[0]
+    # by primary key, then from the card cache
+    assert len(round_trips) == 1
+    assert await get_card_by_uid(cards[0].uid) == cards[0]
+    assert len(round_trips) == 1
+
+    # stale entries fall back to the uid query
+    old_uid = cards[1].uid
+    cards[1].uid = "04AABBCCDDEEFF"
+    await update_card(cards[1])
+    assert await get_card_by_uid(old_uid) is None
+    assert uid_map.get(old_uid) is None
+    assert await get_card_by_uid("04aabbccddeeff") == cards[1]
+    await delete_card(cards[2].id)
+    assert await get_card_by_uid(cards[2].uid) is None
+
+
+@pytest.mark.asyncio
+async def test_uids_differing_in_case_are_normalized_once(migrated_db):
+    card = await create_test_card()
+    row = {key: value for key, value in card.dict().items() if key != "time"}
+    # written before UIDs were normalized, bypassing the models
+    await insert_rows(
+        "cards",
+        [
+            {**row, "id": "B", "uid": "04aabbccddeeff", "external_id": "b"},
+            {**row, "id": "A", "uid": "04AAbbccddeeff", "external_id": "a"},
+            {**row, "id": "C", "uid": "04abcdefabcdef", "external_id": "c"},
+            {**row, "id": "D", "uid": card.uid.lower(), "external_id": "d"},
+        ],
+    )
+    async with db.connect() as conn:
+        await migrations.m007_normalize_card_hex(conn)
+    rows = await db.fetchall(
+        "SELECT id, uid FROM boltcards.cards WHERE id IN ('A', 'B', 'C', 'D')"
+    )
+    assert {row["id"]: row["uid"] for row in rows} == {
+        "A": "04AABBCCDDEEFF",
+        "B": "04aabbccddeeff",
+        "C": "04ABCDEFABCDEF",
+        "D": card.uid.lower(),
+    }
+
+
+@pytest.mark.asyncio
+async def test_oldest_hits_are_read_by_index(migrated_db):
+    if db.type != SQLITE:
+        pytest.skip("query plans differ on postgres")
+    rows = await db.fetchall(
+        "EXPLAIN QUERY PLAN SELECT * FROM boltcards.hits WHERE time < 0 "
+        "ORDER BY time ASC, id ASC LIMIT 500"
+    )
+    plan = " ".join(row["detail"] for row in rows)
+    assert "hits_time_id_idx" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+@pytest.mark.asyncio
+async def test_card_refunds(migrated_db):
+    card, other = await create_test_card(), await create_test_card()
+    hits = [await create_hit(card.id, "127.0.0.1", "test", i, i + 1) for i in range(3)]
+    other_hit = await create_hit(other.id, "127.0.0.1", "test", 0, 1)
+    for hit in (*hits[:2], other_hit):
+        await create_refund(hit.id, 21)
+    refunds = await get_card_refunds(card.id)
+    assert sorted(refund.hit_id for refund in refunds) == sorted(
+        hit.id for hit in hits[:2]
+    )
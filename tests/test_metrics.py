@@ -0,0 +1,70 @@
+import pytest
+from loguru import logger
+
+from .. import metrics
+from ..settings import boltcards_settings
+from .helpers import create_test_card, lnurl_client, sun_params
+
+
+def test_histogram_exposition():
+    histogram = metrics.Histogram("test_seconds", "Test.", ("stage",), (0.1, 1.0))
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5, stage="a")
+    assert histogram.render() == [
+        "# HELP test_seconds Test.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="a",le="0.1"} 1',
+        'test_seconds_bucket{stage="a",le="1.0"} 2',
+        'test_seconds_bucket{stage="a",le="+Inf"} 3',
+        'test_seconds_sum{stage="a"} 5.55',
+        'test_seconds_count{stage="a"} 3',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_scan_records_stages_and_reasons(migrated_db):
+    card = await create_test_card()
+    params = sun_params(card, 1)
+    used = {"endpoint": "api_scan", "reason": "This link is already used."}
+    before = metrics.errors_total.get(**used)
+    inserts = metrics.stage_seconds.count(stage="hit_insert")
+
+    async with lnurl_client() as client:
+        url = f"/boltcards/api/v1/scan/{card.external_id}"
+        await client.get(url, params=params)
+        await client.get(url, params=params)
+
+    assert metrics.errors_total.get(**used) == before + 1
+    assert metrics.stage_seconds.count(stage="hit_insert") == inserts + 1
+    text = metrics.render()
+    assert 'boltcards_stage_seconds_count{stage="sun_decrypt"}' in text
+    assert 'boltcards_request_seconds_count{endpoint="api_scan"}' in text
+
+
+@pytest.mark.asyncio
+async def test_slow_scan_logs_stage_breakdown(migrated_db, monkeypatch):
+    monkeypatch.setattr(boltcards_settings, "slow_request_ms", 0.001)
+    records: list = []
+    sink = logger.add(records.append, level="WARNING")
+    card = await create_test_card()
+    try:
+        async with lnurl_client() as client:
+            await client.get(
+                f"/boltcards/api/v1/scan/{card.external_id}",
+                params=sun_params(card, 1),
+            )
+    finally:
+        logger.remove(sink)
+
+    (record,) = [r.record for r in records if "slow api_scan" in r]
+    assert record["extra"]["path_params"] == {"external_id": card.external_id}
+    assert list(record["extra"]["stages"]) == [
+        "db_lookup",
+        "sun_decrypt",
+        "sun_mac",
+        "counter_update",
+        "limit_check",
+        "hit_insert",
+        "other",
+    ]
@@ -0,0 +1,49 @@
+import time
+
+from ..nxp424 import decrypt_sun, get_sun_keys, get_sun_mac
+
+# https://github.com/boltcard/boltcard/blob/main/docs/TEST_VECTORS.md
+K1 = "0c3b25d92b38ae443229dd59ad34b85d"
+K2 = "b45775776cb224c75bcde7ca3704e933"
+UID = "04996c6a926980"
+VECTORS = [
+    ("4E2E289D945A66BB13377A728884E867", "E19CCB1FED8892CE", 3),
+    ("00F48C4F8E386DED06BCDC78FA92E2FE", "66B4826EA4C155B4", 5),
+    ("0DBF3C59B59B0638D60B5842A997D4D1", "CC61660C020B4D96", 7),
+]
+
+
+def _verify(p: str, c: str) -> bool:
+    uid, counter = decrypt_sun(bytes.fromhex(p), bytes.fromhex(K1))
+    return get_sun_mac(uid, counter, bytes.fromhex(K2)).hex().upper() == c
+
+
+def _verify_prepared(p: str, c: str) -> bool:
+    keys = get_sun_keys(K1, K2)
+    uid, counter = keys.decrypt_sun(bytes.fromhex(p))
+    return keys.get_sun_mac(uid, counter).hex().upper() == c
+
+
+def test_test_vectors():
+    keys = get_sun_keys(K1, K2)
+    for p, c, ctr in VECTORS:
+        uid, counter = keys.decrypt_sun(bytes.fromhex(p))
+        assert uid.hex() == UID
+        assert int.from_bytes(counter, "little") == ctr
+        assert keys.get_sun_mac(uid, counter).hex().upper() == c
+        assert (uid, counter) == decrypt_sun(bytes.fromhex(p), bytes.fromhex(K1))
+
+
+def test_sun_verification_rate():
+    rounds = 2000
+    rates = {}
+    for name, verify in (("plain", _verify), ("prepared", _verify_prepared)):
+        start = time.perf_counter()
+        for i in range(rounds):
+            p, c, _ = VECTORS[i % len(VECTORS)]
+            assert verify(p, c)
+        rates[name] = rounds / (time.perf_counter() - start)
+    print(
+        f"SUN verifications/s: plain {rates['plain']:.0f}, "
+        f"prepared {rates['prepared']:.0f}"
+    )
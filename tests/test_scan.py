@@ -0,0 +1,216 @@
+import asyncio
+import secrets
+
+import pytest
+
+from .. import views_lnurl
+from ..crud import get_card, get_card_by_uid, get_hits, update_card
+from ..models import ZERO_KEY
+from .helpers import api_client, create_test_card, lnurl_client, sun_params
+
+USED = "This link is already used."
+THROTTLED = "Too many requests."
+
+
+def _reason(res) -> str | None:
+    """Why a scan was rejected, None if it was accepted."""
+    assert res.status_code == 200
+    body = res.json()
+    if body.get("status") == "ERROR":
+        return body["reason"]
+    assert body["tag"] == "withdrawRequest"
+    return None
+
+
+@pytest.mark.asyncio
+async def test_scan_rejects_replay(migrated_db):
+    card = await create_test_card()
+    params = sun_params(card, 1)
+    async with lnurl_client() as client:
+        url = f"/boltcards/api/v1/scan/{card.external_id}"
+        first = await client.get(url, params=params)
+        second = await client.get(url, params=params)
+    assert _reason(first) is None
+    assert _reason(second) == USED
+    (hit,) = await get_hits([card.id])
+    assert first.json()["k1"] == hit.id
+    pay_link = f"lnurlp://localhost/boltcards/api/v1/lnurlp/{hit.id}"
+    assert first.json()["payLink"] == pay_link
+
+
+@pytest.mark.asyncio
+async def test_concurrent_scans_accept_exactly_one(migrated_db, monkeypatch):
+    monkeypatch.setattr(views_lnurl.card_limiter, "rate", 0)
+    monkeypatch.setattr(views_lnurl.ip_limiter, "rate", 0)
+    card = await create_test_card()
+    params = sun_params(card, 7)
+    async with lnurl_client() as client:
+        url = f"/boltcards/api/v1/scan/{card.external_id}"
+        responses = await asyncio.gather(
+            *[client.get(url, params=params) for _ in range(20)]
+        )
+    reasons = [_reason(res) for res in responses]
+    assert reasons.count(None) == 1
+    assert reasons.count(USED) == 19
+    assert len(await get_hits([card.id])) == 1
+    card = await get_card(card.id)
+    assert card
+    assert card.counter == 7
+
+
+@pytest.mark.asyncio
+async def test_scans_are_throttled_per_card_and_ip(migrated_db, monkeypatch):
+    for limiter, burst in ((views_lnurl.card_limiter, 3), (views_lnurl.ip_limiter, 4)):
+        # slow enough that no tokens are refilled during the test
+        monkeypatch.setattr(limiter, "rate", 0.001)
+        monkeypatch.setattr(limiter, "burst", burst)
+    card = await create_test_card()
+    other = await create_test_card()
+    async with lnurl_client() as client:
+        url = f"/boltcards/api/v1/scan/{card.external_id}"
+        card_reasons = [
+            _reason(await client.get(url, params=sun_params(card, counter)))
+            for counter in (1, 2, 3, 4)
+        ]
+        url = f"/boltcards/api/v1/scan/{other.external_id}"
+        other_reasons = [
+            _reason(await client.get(url, params=sun_params(other, counter)))
+            for counter in (1, 2)
+        ]
+        forwarded = await client.get(
+            url, params=sun_params(other, 3), headers={"x-real-ip": "10.0.0.1"}
+        )
+    assert card_reasons == [None, None, None, THROTTLED]
+    assert other_reasons == [None, THROTTLED]
+    assert _reason(forwarded) is None
+    # throttled scans never reach the counter update
+    assert len(await get_hits([card.id])) == 3
+
+
+@pytest.mark.asyncio
+async def test_scan_accepts_lower_case_sun(migrated_db):
+    card = await create_test_card(uid="04aabbccddeeff", k1="AB" * 16)
+    assert card == await get_card_by_uid("04aabbccddeeff")
+    assert card.uid == "04AABBCCDDEEFF"
+    assert card.k1 == "ab" * 16
+    params = {key: value.lower() for key, value in sun_params(card, 1).items()}
+    async with lnurl_client() as client:
+        res = await client.get(
+            f"/boltcards/api/v1/scan/{card.external_id}", params=params
+        )
+    assert _reason(res) is None
+    assert len(await get_hits([card.id])) == 1
+
+
+@pytest.mark.asyncio
+async def test_scan_falls_back_to_previous_keys(migrated_db):
+    old = await create_test_card()
+    async with api_client() as client:
+        res = await client.post(f"/boltcards/api/v1/cards/{old.id}/rotate")
+        again = await client.post(f"/boltcards/api/v1/cards/{old.id}/rotate")
+    assert res.status_code == 200
+    assert again.status_code == 400
+    new = await get_card(old.id)
+    assert new
+    assert new.k1 != old.k1
+    assert new.prev_k1 == old.k1
+    async with lnurl_client() as client:
+        url = f"/boltcards/api/v1/scan/{old.external_id}"
+        first = await client.get(url, params=sun_params(old, 1))
+        card = await get_card(old.id)
+        assert card
+        assert card.rotating
+        second = await client.get(url, params=sun_params(new, 2))
+    assert _reason(first) is None
+    assert _reason(second) is None
+    hits = sorted(await get_hits([old.id]), key=lambda hit: hit.new_ctr)
+    assert [hit.key_version for hit in hits] == [1, 0]
+    card = await get_card(old.id)
+    assert card
+    assert not card.rotating
+    assert card.prev_k1 == ZERO_KEY
+    async with lnurl_client() as client:
+        res = await client.get(url, params=sun_params(old, 3))
+    assert _reason(res) == "Card UID mis-match."
+
+
+@pytest.mark.asyncio
+async def test_wipe_serves_previous_keys_while_rotating(migrated_db):
+    old = await create_test_card()
+    async with api_client() as client:
+        await client.post(f"/boltcards/api/v1/cards/{old.id}/rotate")
+    new = await get_card(old.id)
+    assert new
+    async with lnurl_client() as client:
+        url = "/boltcards/api/v1/auth"
+        wipe = await client.post(f"{url}?a={new.otp}&wipe=true", json={})
+        program = await client.post(f"{url}?a={new.otp}", json={"UID": new.uid})
+        await client.get(
+            f"/boltcards/api/v1/scan/{old.external_id}", params=sun_params(new, 1)
+        )
+        rotated = await get_card(old.id)
+        assert rotated
+        wiped = await client.post(f"{url}?a={rotated.otp}&wipe=true", json={})
+    assert wipe.json()["action"] == "wipe"
+    assert [wipe.json()[k] for k in ("K0", "K1", "K2", "K3", "K4")] == [
+        old.k0,
+        old.k1,
+        old.k2,
+        old.k1,
+        old.k2,
+    ]
+    assert program.json()["K1"] == new.k1
+    assert wiped.json()["K1"] == new.k1
+
+
+@pytest.mark.asyncio
+async def test_invalid_previous_keys(migrated_db):
+    card = await create_test_card()
+    data = {key: getattr(card, key) for key in ("card_name", "uid", "k0", "k1", "k2")}
+    async with api_client() as client:
+        res = await client.put(
+            f"/boltcards/api/v1/cards/{card.id}", json={**data, "prev_k1": "zz"}
+        )
+    assert res.status_code == 400
+    # stored before the validation, the current keys still verify
+    card.prev_k1 = ""
+    await update_card(card)
+    async with lnurl_client() as client:
+        res = await client.get(
+            f"/boltcards/api/v1/scan/{card.external_id}", params=sun_params(card, 1)
+        )
+    assert _reason(res) is None
+    assert len(await get_hits([card.id])) == 1
+
+
+@pytest.mark.asyncio
+async def test_keys_replaced_in_the_edit_dialog_are_retired(migrated_db):
+    old = await create_test_card()
+    # the edit dialog keeps replaced keys in prev_k0..prev_k2, as before m008
+    data = {
+        "card_name": old.card_name,
+        "uid": old.uid,
+        "k0": secrets.token_hex(16),
+        "k1": secrets.token_hex(16),
+        "k2": secrets.token_hex(16),
+        "prev_k0": old.k0,
+        "prev_k1": old.k1,
+        "prev_k2": old.k2,
+    }
+    async with api_client() as client:
+        res = await client.put(f"/boltcards/api/v1/cards/{old.id}", json=data)
+    assert res.status_code == 200
+    assert res.json()["prev_k1"] == old.k1
+    assert not res.json()["rotating"]
+    card = await get_card(old.id)
+    assert card
+    async with lnurl_client() as client:
+        scan = await client.get(
+            f"/boltcards/api/v1/scan/{old.external_id}", params=sun_params(old, 1)
+        )
+        wipe = await client.post(
+            f"/boltcards/api/v1/auth?a={card.otp}&wipe=true", json={}
+        )
+    assert _reason(scan) == "Card UID mis-match."
+    assert await get_hits([old.id]) == []
+    assert wipe.json()["K1"] == data["k1"]
@@ -0,0 +1,183 @@
+import asyncio
+import gzip
+import json
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from .. import crud, tasks
+from ..crud import (
+    add_card_daily_spend,
+    create_hit,
+    create_refunds,
+    get_card_daily_spend,
+    get_hits,
+    get_refunds,
+)
+from .helpers import create_test_card, insert_rows
+
+
+@pytest.fixture
+def core_payments(monkeypatch):
+    """Payments marked as sent by `on_invoices_paid`, without a core database."""
+    updated: list = []
+
+    @asynccontextmanager
+    async def connect():
+        yield None
+
+    async def update_payment(payment, conn=None):
+        updated.append(payment)
+
+    monkeypatch.setattr(tasks, "core_db", SimpleNamespace(connect=connect))
+    monkeypatch.setattr(tasks, "update_payment", update_payment)
+    return updated
+
+
+def _payment(hit_id: str, payment_hash: str, amount_sat: int = 21):
+    return SimpleNamespace(
+        extra={"refund": hit_id}, amount=amount_sat * 1000, payment_hash=payment_hash
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returning", [True, False])
+async def test_concurrent_refunds_of_a_payment_insert_one(
+    migrated_db, monkeypatch, returning
+):
+    monkeypatch.setattr(crud, "_supports_returning", lambda: returning)
+    card = await create_test_card()
+    hit = await create_hit(card.id, "127.0.0.1", "test", 0, 1)
+    results = await asyncio.gather(
+        *[create_refunds([(hit.id, 21, "hash")]) for _ in range(5)]
+    )
+    assert sum(len(refunds) for refunds in results) == 1
+    assert len(await get_refunds([hit.id])) == 1
+
+
+@pytest.mark.asyncio
+async def test_replayed_payments_refund_once(migrated_db, core_payments):
+    card = await create_test_card()
+    hit = await create_hit(card.id, "127.0.0.1", "test", 0, 1)
+    await tasks.on_invoices_paid(
+        [_payment(hit.id, "a"), _payment(hit.id, "a"), _payment(hit.id, "b")]
+    )
+    await tasks.on_invoices_paid([_payment(hit.id, "b"), _payment(hit.id, "c")])
+    refunds = await get_refunds([hit.id])
+    assert sorted(refund.payment_hash for refund in refunds) == ["a", "b", "c"]
+    (daily,) = await get_card_daily_spend(card.id)
+    assert daily.refund_total == 3 * 21 * 1000
+    assert len(core_payments) == 5
+
+
+@pytest.mark.asyncio
+async def test_payment_workers_keep_payments_of_a_hit_in_order(monkeypatch):
+    monkeypatch.setattr(tasks.boltcards_settings, "payment_workers", 3)
+    monkeypatch.setattr(tasks.boltcards_settings, "payment_batch_window", 0.01)
+    monkeypatch.setattr(tasks.boltcards_settings, "payment_batch_size", 4)
+    monkeypatch.setattr(tasks, "payment_queue_stats", tasks.PaymentQueueStats())
+    listener: asyncio.Queue = asyncio.Queue()
+    recorded: list[tuple[asyncio.Task | None, str]] = []
+
+    async def on_invoices_paid(payments):
+        await asyncio.sleep(0)
+        if any(payment.payment_hash == "fail" for payment in payments):
+            raise ValueError("boom")
+        task = asyncio.current_task()
+        recorded.extend((task, payment.payment_hash) for payment in payments)
+
+    def register(queue, name):
+        nonlocal listener
+        listener = queue
+
+    monkeypatch.setattr(tasks, "register_invoice_listener", register)
+    monkeypatch.setattr(tasks, "on_invoices_paid", on_invoices_paid)
+    payments = [
+        _payment(f"hit{i % 5}", f"hit{i % 5}-{i}" if i != 7 else "fail")
+        for i in range(40)
+    ]
+    dispatcher = asyncio.create_task(tasks.wait_for_paid_invoices())
+    await asyncio.sleep(0)
+    for payment in payments:
+        await listener.put(payment)
+    while tasks.payment_queue_stats.processed < len(payments):
+        await asyncio.sleep(0.01)
+    dispatcher.cancel()
+
+    stats = tasks.payment_queue_stats.stats()
+    assert stats["workers"] == 3
+    # the batch with the failing payment is retried one payment at a time
+    assert stats["failed"] == 1
+    assert 1 < stats["batches"] < len(payments)
+    for hit in range(5):
+        hashes = [h for _, h in recorded if h.startswith(f"hit{hit}-")]
+        expected = [
+            p.payment_hash
+            for p in payments
+            if p.extra["refund"] == f"hit{hit}" and p.payment_hash != "fail"
+        ]
+        assert hashes == expected
+        assert len({task for task, h in recorded if h in hashes}) == 1
+    assert len(recorded) == len(payments) - 1
+
+
+def _read_ndjson(path) -> list[dict]:
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+@pytest.mark.asyncio
+async def test_purge_old_hits_archives_in_batches(migrated_db, monkeypatch, tmp_path):
+    monkeypatch.setattr(tasks.boltcards_settings, "hits_retention_days", 30)
+    monkeypatch.setattr(tasks.boltcards_settings, "retention_batch_size", 3)
+    monkeypatch.setattr(tasks.boltcards_settings, "archive_folder", str(tmp_path))
+    batches: list[list[str]] = []
+
+    async def delete_hits(hits_ids):
+        await crud.delete_hits(hits_ids)
+        batches.append(hits_ids)
+
+    monkeypatch.setattr(tasks, "delete_hits", delete_hits)
+    card = await create_test_card()
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    old = now - timedelta(days=40)
+    await insert_rows(
+        "hits",
+        [
+            {
+                "id": f"hit{i}",
+                "card_id": card.id,
+                "ip": "127.0.0.1",
+                "spent": True,
+                "useragent": "test",
+                "old_ctr": i,
+                "new_ctr": i + 1,
+                "amount": 10,
+                "time": old if i < 7 else now,
+            }
+            for i in range(9)
+        ],
+    )
+    await create_refunds([("hit1", 5, "old"), ("hit8", 5, "recent")])
+    await add_card_daily_spend(card.id, old, spent_msat=70_000, tap_count=7)
+
+    purge = asyncio.create_task(tasks.purge_old_hits())
+    while sum(len(batch) for batch in batches) < 7:
+        await asyncio.sleep(0.01)
+    purge.cancel()
+
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    (hits_file,) = tmp_path.glob("hits-*.ndjson.gz")
+    (refunds_file,) = tmp_path.glob("refunds-*.ndjson.gz")
+    assert [hit["id"] for hit in _read_ndjson(hits_file)] == [
+        f"hit{i}" for i in range(7)
+    ]
+    assert [refund["hit_id"] for refund in _read_ndjson(refunds_file)] == ["hit1"]
+    assert sorted(hit.id for hit in await get_hits([card.id])) == ["hit7", "hit8"]
+    assert await get_refunds(["hit1"]) == []
+    assert len(await get_refunds(["hit8"])) == 1
+    (daily,) = await get_card_daily_spend(card.id)
+    assert daily.tap_count == 7
+    assert daily.spent_msat == 70_000
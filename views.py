@@ -7,7 +7,12 @@ from lnbits.core.models import User
 from lnbits.decorators import check_user_exists, optional_user_id
 from lnbits.helpers import template_renderer
 
-from .crud import get_card_by_external_id, get_hits, get_refunds
+from .crud import (
+    get_card_by_external_id,
+    get_card_refunds,
+    get_hits,
+    get_spent_today,
+)
 
 boltcards_generic_router = APIRouter()
 
@@ -47,7 +52,7 @@ async def display(
         wallet_balance = wallet.balance
     hits = await get_hits([card.id])
     hits_json = [hit.json() for hit in hits]
-    refunds = [refund.hit_id for refund in await get_refunds([hit.id for hit in hits])]
+    refunds = [refund.hit_id for refund in await get_card_refunds(card.id)]
     card_json = card.json(exclude={"wallet"})
     return boltcards_renderer().TemplateResponse(
         "boltcards/display.html",
@@ -57,5 +62,6 @@ async def display(
             "hits": hits_json,
             "refunds": refunds,
             "balance": int(wallet_balance),
+            "spent_today": await get_spent_today(card.id),
         },
     )
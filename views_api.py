@@ -1,22 +1,69 @@
+import asyncio
+import csv
+import hmac
+import io
+import secrets
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from datetime import datetime, timezone
 from http import HTTPStatus
-
-from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Literal
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from lnbits.core.crud import get_user
 from lnbits.core.models import WalletTypeInfo
-from lnbits.decorators import require_admin_key, require_invoice_key
+from lnbits.decorators import check_admin, require_admin_key, require_invoice_key
+from lnbits.helpers import urlsafe_short_hash
+from pydantic import BaseModel
 
+from . import metrics
+from .card_archive import ArchiveError, read_archive, write_archive
 from .crud import (
+    card_cache,
     create_card,
+    create_cards,
     delete_card,
+    delete_cards,
     enable_disable_card,
     get_card,
     get_card_by_uid,
+    get_card_daily_spend,
     get_cards,
+    get_cards_by_external_ids,
+    get_cards_by_ids,
+    get_cards_by_uids,
     get_hits,
-    get_refunds,
+    get_wallet_cards_after,
+    get_wallets_refunds,
+    import_cards,
     update_card,
+    update_card_counter,
 )
-from .models import Card, CreateCardData, Hit, Refund
+from .models import (
+    BatchVerifyData,
+    Card,
+    CardDailySpend,
+    CardsImportResult,
+    CreateCardData,
+    CreateCardsData,
+    DeleteCardsData,
+    Hit,
+    ProvisionedCard,
+    Refund,
+    RotateKeysData,
+    SkippedCard,
+    SunTap,
+    SunVerdict,
+)
+from .tasks import payment_queue_stats
 
 boltcards_api_router = APIRouter()
 
@@ -25,13 +72,7 @@ boltcards_api_router = APIRouter()
 async def api_cards(
     key_info: WalletTypeInfo = Depends(require_invoice_key), all_wallets: bool = False
 ) -> list[Card]:
-    wallet_ids = [key_info.wallet.id]
-
-    if all_wallets:
-        user = await get_user(key_info.wallet.user)
-        wallet_ids = user.wallet_ids if user else []
-
-    return await get_cards(wallet_ids)
+    return await get_cards(await _wallet_ids(key_info, all_wallets))
 
 
 def validate_card(data: CreateCardData):
@@ -55,6 +96,13 @@ def validate_card(data: CreateCardData):
             raise HTTPException(
                 detail="Invalid bytes for k2.", status_code=HTTPStatus.BAD_REQUEST
             )
+
+        for key in ("prev_k0", "prev_k1", "prev_k2"):
+            if len(bytes.fromhex(getattr(data, key))) != 16:
+                raise HTTPException(
+                    detail=f"Invalid bytes for {key}.",
+                    status_code=HTTPStatus.BAD_REQUEST,
+                )
     except Exception as exc:
         raise HTTPException(
             detail="Invalid byte data provided.", status_code=HTTPStatus.BAD_REQUEST
@@ -84,12 +132,61 @@ async def api_card_update(
             detail="UID already registered. Delete registered card and try again.",
             status_code=HTTPStatus.BAD_REQUEST,
         )
+    if (data.k0, data.k1, data.k2) != (card.k0, card.k1, card.k2):
+        # keys set by hand end a pending rotation, the previous keys are retired
+        card.rotating = False
     for key, value in data.dict().items():
         setattr(card, key, value)
     await update_card(card)
     return card
 
 
+@boltcards_api_router.post("/api/v1/cards/{card_id}/rotate")
+async def api_card_rotate(
+    card_id: str,
+    data: RotateKeysData | None = None,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+) -> Card:
+    """
+    Start a key rotation. The current keys become the previous keys, which
+    taps are still verified with until the card taps with the new keys.
+    """
+    card = await get_card(card_id)
+    if not card:
+        raise HTTPException(
+            detail="Card does not exist.", status_code=HTTPStatus.NOT_FOUND
+        )
+    if card.wallet != wallet.wallet.id:
+        raise HTTPException(detail="Not your card.", status_code=HTTPStatus.FORBIDDEN)
+    if card.rotating:
+        raise HTTPException(
+            detail="Card has not tapped with its rotated keys yet.",
+            status_code=HTTPStatus.BAD_REQUEST,
+        )
+    data = data or RotateKeysData()
+    keys = {
+        key: getattr(data, key) or secrets.token_hex(16) for key in ("k0", "k1", "k2")
+    }
+    for key, value in keys.items():
+        try:
+            valid = len(bytes.fromhex(value)) == 16
+        except ValueError:
+            valid = False
+        if not valid:
+            raise HTTPException(
+                detail=f"Invalid bytes for {key}.", status_code=HTTPStatus.BAD_REQUEST
+            )
+    card.prev_k0, card.prev_k1, card.prev_k2 = card.k0, card.k1, card.k2
+    card.k0, card.k1, card.k2 = keys["k0"], keys["k1"], keys["k2"]
+    card.rotating = True
+    # a new otp, so the card can be programmed from the auth link again
+    card.otp = secrets.token_hex(16)
+    await update_card(card)
+    # the first taps after the rotation should not pay for the key schedule
+    list(card.sun_keys())
+    return card
+
+
 @boltcards_api_router.post(
     "/api/v1/cards",
     status_code=HTTPStatus.CREATED,
@@ -114,6 +211,169 @@ async def api_card_create(
     return card
 
 
+@boltcards_api_router.post("/api/v1/cards/bulk", status_code=HTTPStatus.CREATED)
+async def api_cards_create(
+    data: CreateCardsData,
+    request: Request,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+) -> list[ProvisionedCard]:
+    """
+    Provision many cards at once. Cards given only by UID get random keys.
+    Returns the card with the auth link to program it, in input order.
+    """
+    cards = data.cards + [
+        CreateCardData(
+            card_name=data.card_name or uid,
+            uid=uid,
+            tx_limit=data.tx_limit,
+            daily_limit=data.daily_limit,
+            k0=secrets.token_hex(16),
+            k1=secrets.token_hex(16),
+            k2=secrets.token_hex(16),
+        )
+        for uid in data.uids
+    ]
+    if not 0 < len(cards) <= 5000:
+        raise HTTPException(
+            detail="Provide between 1 and 5000 cards.",
+            status_code=HTTPStatus.BAD_REQUEST,
+        )
+    uids: set[str] = set()
+    for i, card in enumerate(cards):
+        try:
+            validate_card(card)
+        except HTTPException as exc:
+            raise HTTPException(
+                detail=f"Card {i}: {exc.detail}", status_code=exc.status_code
+            ) from exc
+        if card.uid in uids:
+            raise HTTPException(
+                detail=f"Card {i}: UID {card.uid} is given more than once.",
+                status_code=HTTPStatus.BAD_REQUEST,
+            )
+        uids.add(card.uid)
+    registered = await get_cards_by_uids(list(uids))
+    if registered:
+        raise HTTPException(
+            detail="UIDs already registered: "
+            + ", ".join(card.uid for card in registered),
+            status_code=HTTPStatus.BAD_REQUEST,
+        )
+    auth_url = request.url_for("boltcards.api_auth")
+    return [
+        ProvisionedCard(card=card, auth_link=f"{auth_url}?a={card.otp}")
+        for card in await create_cards(cards, wallet.wallet.id)
+    ]
+
+
+@boltcards_api_router.get("/api/v1/cards/export")
+async def api_cards_export(
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+    passphrase: str = Header(..., alias="x-archive-passphrase", min_length=8),
+) -> StreamingResponse:
+    """
+    Stream all cards of the wallet, keys and counters included, as an
+    encrypted archive for `/api/v1/cards/import` on another instance.
+    """
+
+    async def rows() -> AsyncGenerator[dict, None]:
+        after = None
+        while True:
+            cards = await get_wallet_cards_after(wallet.wallet.id, after, 1000)
+            for card in cards:
+                yield card.dict()
+            if len(cards) < 1000:
+                return
+            after = cards[-1].id
+
+    return StreamingResponse(
+        write_archive(rows(), passphrase),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": "attachment; filename=boltcards.archive"},
+    )
+
+
+@boltcards_api_router.post("/api/v1/cards/import")
+async def api_cards_import(
+    request: Request,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+    passphrase: str = Header(..., alias="x-archive-passphrase", min_length=8),
+    on_conflict: Literal["skip", "replace"] = Query("skip"),
+) -> CardsImportResult:
+    """
+    Import a card archive from the request body into the wallet, as it is
+    uploaded and in chunks. A card whose UID is already registered is skipped,
+    or with `on_conflict=replace` overwritten if it belongs to this wallet.
+    Cards keep their external id, as it is programmed into the card.
+    """
+    result = CardsImportResult()
+    chunk: list[Card] = []
+    try:
+        async for row in read_archive(request.stream(), passphrase):
+            chunk.append(Card.parse_obj(row))
+            if len(chunk) == 1000:
+                await _import_cards(chunk, wallet.wallet.id, on_conflict, result)
+                chunk = []
+        await _import_cards(chunk, wallet.wallet.id, on_conflict, result)
+    except (ArchiveError, ValueError) as exc:
+        raise HTTPException(
+            detail=f"Invalid archive: {exc} "
+            f"{result.imported + result.replaced} cards were imported before.",
+            status_code=HTTPStatus.BAD_REQUEST,
+        ) from exc
+    return result
+
+
+async def _import_cards(
+    cards: list[Card],
+    wallet_id: str,
+    on_conflict: Literal["skip", "replace"],
+    result: CardsImportResult,
+) -> None:
+    registered = {
+        card.uid: card for card in await get_cards_by_uids([card.uid for card in cards])
+    }
+    external_ids = {
+        card.external_id: card
+        for card in await get_cards_by_external_ids(
+            [card.external_id for card in cards]
+        )
+    }
+    new: list[Card] = []
+    replaced: list[Card] = []
+    seen: set[str] = set()
+    for card in cards:
+        card.external_id = card.external_id.lower()
+        existing = registered.get(card.uid)
+        owner = external_ids.get(card.external_id)
+        reason = None
+        if card.uid in seen or card.external_id in seen:
+            reason = "Duplicate card in the archive."
+        elif existing and on_conflict == "skip":
+            reason = "UID already registered."
+        elif existing and existing.wallet != wallet_id:
+            reason = "UID registered in another wallet."
+        elif owner and owner.id != (existing.id if existing else None):
+            reason = "External id used by another card."
+        if reason:
+            result.skipped.append(SkippedCard(uid=card.uid, reason=reason))
+            continue
+        seen.update((card.uid, card.external_id))
+        card.wallet = wallet_id
+        if existing:
+            card.id = existing.id
+            card.time = existing.time
+            # never move a counter back, old taps would become valid again
+            card.counter = max(card.counter, existing.counter)
+            replaced.append(card)
+        else:
+            card.id = urlsafe_short_hash().upper()
+            new.append(card)
+    await import_cards(new, replaced)
+    result.imported += len(new)
+    result.replaced += len(replaced)
+
+
 @boltcards_api_router.get(
     "/api/v1/cards/enable/{card_id}/{enable}", status_code=HTTPStatus.OK
 )
@@ -153,43 +413,270 @@ async def api_card_delete(
     await delete_card(card_id)
 
 
+@boltcards_api_router.post("/api/v1/cards/delete")
+async def api_cards_delete(
+    data: DeleteCardsData, wallet: WalletTypeInfo = Depends(require_admin_key)
+) -> None:
+    cards = await get_cards_by_ids(data.ids)
+    if len(cards) != len(set(data.ids)):
+        raise HTTPException(
+            detail="Card does not exist.", status_code=HTTPStatus.NOT_FOUND
+        )
+    if any(card.wallet != wallet.wallet.id for card in cards):
+        raise HTTPException(detail="Not your card.", status_code=HTTPStatus.FORBIDDEN)
+
+    await delete_cards([card.id for card in cards])
+
+
+@boltcards_api_router.get("/api/v1/cards/{card_id}/daily")
+async def api_card_daily_spend(
+    card_id: str,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    since: datetime | None = Query(None),
+) -> list[CardDailySpend]:
+    card = await get_card(card_id)
+    if not card:
+        raise HTTPException(
+            detail="Card does not exist.", status_code=HTTPStatus.NOT_FOUND
+        )
+    if card.wallet != key_info.wallet.id:
+        raise HTTPException(detail="Not your card.", status_code=HTTPStatus.FORBIDDEN)
+    return await get_card_daily_spend(card_id, since)
+
+
 @boltcards_api_router.get("/api/v1/hits")
 async def api_hits(
+    response: Response,
     key_info: WalletTypeInfo = Depends(require_invoice_key),
     all_wallets: bool = Query(False),
+    card_id: str | None = Query(None),
+    since: datetime | None = Query(None),
+    until: datetime | None = Query(None),
+    cursor: str | None = Query(None),
+    limit: int | None = Query(None, ge=1, le=1000),
 ) -> list[Hit]:
-    wallet_ids = [key_info.wallet.id]
-
-    if all_wallets:
-        user = await get_user(key_info.wallet.user)
-        wallet_ids = user.wallet_ids if user else []
-
-    cards = await get_cards(wallet_ids)
-    cards_ids = []
-    for card in cards:
-        cards_ids.append(card.id)
-
-    return await get_hits(cards_ids)
+    cards_ids = await _filtered_card_ids(key_info, all_wallets, card_id)
+    hits = await get_hits(
+        cards_ids,
+        since=since,
+        until=until,
+        before=_decode_cursor(cursor),
+        limit=limit,
+    )
+    if limit and len(hits) == limit:
+        response.headers["x-next-cursor"] = _encode_cursor(hits[-1].time, hits[-1].id)
+    return hits
 
 
 @boltcards_api_router.get("/api/v1/refunds")
 async def api_refunds(
+    response: Response,
     key_info: WalletTypeInfo = Depends(require_invoice_key),
     all_wallets: bool = Query(False),
+    card_id: str | None = Query(None),
+    since: datetime | None = Query(None),
+    until: datetime | None = Query(None),
+    cursor: str | None = Query(None),
+    limit: int | None = Query(None, ge=1, le=1000),
 ) -> list[Refund]:
-    wallet_ids = [key_info.wallet.id]
+    refunds = await get_wallets_refunds(
+        await _wallet_ids(key_info, all_wallets),
+        card_id=card_id,
+        since=since,
+        until=until,
+        before=_decode_cursor(cursor),
+        limit=limit,
+    )
+    if limit and len(refunds) == limit:
+        response.headers["x-next-cursor"] = _encode_cursor(
+            refunds[-1].time, refunds[-1].id
+        )
+    return refunds
 
+
+@boltcards_api_router.get("/api/v1/export/{kind}")
+async def api_export(
+    kind: Literal["hits", "refunds"],
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+    all_wallets: bool = Query(False),
+    card_id: str | None = Query(None),
+    since: datetime | None = Query(None),
+    until: datetime | None = Query(None),
+) -> StreamingResponse:
+    """
+    Stream all hits or refunds of the wallets, newest first. Rows are read in
+    keyset chunks so memory use does not grow with the size of the export.
+    """
+    fetch: Callable[..., Awaitable[list]]
+    if kind == "hits":
+        cards_ids = await _filtered_card_ids(key_info, all_wallets, card_id)
+
+        async def fetch(**kwargs):
+            return await get_hits(cards_ids, since=since, until=until, **kwargs)
+
+        model: type[BaseModel] = Hit
+    else:
+        wallet_ids = await _wallet_ids(key_info, all_wallets)
+
+        async def fetch(**kwargs):
+            return await get_wallets_refunds(
+                wallet_ids, card_id=card_id, since=since, until=until, **kwargs
+            )
+
+        model = Refund
+
+    rows = _iter_chunks(fetch)
+    if export_format == "csv":
+        return StreamingResponse(
+            _csv_lines(rows, list(model.__fields__)),
+            media_type="text/csv",
+            headers={"Content-Disposition": f"attachment; filename={kind}.csv"},
+        )
+    return StreamingResponse(
+        (f"{row.json()}\n" async for row in rows),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={kind}.ndjson"},
+    )
+
+
+async def _iter_chunks(
+    fetch: Callable[..., Awaitable[list]], chunk_size: int = 1000
+) -> AsyncGenerator:
+    before = None
+    while True:
+        rows = await fetch(before=before, limit=chunk_size)
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        before = (rows[-1].time, rows[-1].id)
+
+
+async def _csv_lines(rows: AsyncGenerator, fields: list[str]) -> AsyncGenerator:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    async for row in rows:
+        writer.writerow([getattr(row, field) for field in fields])
+        if buffer.tell() > 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+async def _wallet_ids(key_info: WalletTypeInfo, all_wallets: bool) -> list[str]:
     if all_wallets:
         user = await get_user(key_info.wallet.user)
-        wallet_ids = user.wallet_ids if user else []
+        return user.wallet_ids if user else []
+    return [key_info.wallet.id]
 
-    cards = await get_cards(wallet_ids)
-    cards_ids = []
-    for card in cards:
-        cards_ids.append(card.id)
-    hits = await get_hits(cards_ids)
-    hits_ids = []
-    for hit in hits:
-        hits_ids.append(hit.id)
 
-    return await get_refunds(hits_ids)
+async def _filtered_card_ids(
+    key_info: WalletTypeInfo, all_wallets: bool, card_id: str | None
+) -> list[str]:
+    cards = await get_cards(await _wallet_ids(key_info, all_wallets))
+    return [card.id for card in cards if not card_id or card.id == card_id]
+
+
+def _encode_cursor(time: datetime, item_id: str) -> str:
+    return f"{time.timestamp()}:{item_id}"
+
+
+def _decode_cursor(cursor: str | None) -> tuple[datetime, str] | None:
+    if not cursor:
+        return None
+    try:
+        timestamp, item_id = cursor.split(":", 1)
+        return datetime.fromtimestamp(float(timestamp), timezone.utc), item_id
+    except ValueError as exc:
+        raise HTTPException(
+            detail="Invalid cursor.", status_code=HTTPStatus.BAD_REQUEST
+        ) from exc
+
+
+@boltcards_api_router.get("/api/v1/cache", dependencies=[Depends(check_admin)])
+async def api_cache_stats() -> dict:
+    return card_cache.stats()
+
+
+@boltcards_api_router.get("/api/v1/payments/stats", dependencies=[Depends(check_admin)])
+async def api_payment_stats() -> dict:
+    return payment_queue_stats.stats()
+
+
+@boltcards_api_router.get("/api/v1/metrics", dependencies=[Depends(check_admin)])
+async def api_metrics() -> PlainTextResponse:
+    """Tap and payment pipeline metrics in the Prometheus text format."""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@boltcards_api_router.post("/api/v1/verify")
+async def api_verify_taps(
+    data: BatchVerifyData,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+) -> list[SunVerdict]:
+    """
+    Verify taps buffered by an offline terminal and advance the card counters.
+    Taps of one card are accepted in counter order, replays are rejected.
+    """
+    cards = {
+        card.external_id: card
+        for card in await get_cards_by_external_ids(
+            [tap.external_id for tap in data.taps]
+        )
+        if card.wallet == key_info.wallet.id
+    }
+    verdicts = await asyncio.to_thread(
+        lambda: [
+            _verify_tap(tap, cards.get(tap.external_id.lower())) for tap in data.taps
+        ]
+    )
+
+    accepted: dict[str, list[SunVerdict]] = {}
+    for verdict in verdicts:
+        if verdict.valid:
+            accepted.setdefault(verdict.external_id.lower(), []).append(verdict)
+    for external_id, card_verdicts in accepted.items():
+        card = cards[external_id]
+        counter = card.counter
+        for verdict in sorted(card_verdicts, key=lambda v: v.counter or 0):
+            if not verdict.counter or verdict.counter <= counter:
+                verdict.valid = False
+                verdict.reason = "This link is already used."
+            else:
+                counter = verdict.counter
+        if counter > card.counter and not await update_card_counter(counter, card.id):
+            for verdict in card_verdicts:
+                verdict.valid = False
+                verdict.reason = "This link is already used."
+    return verdicts
+
+
+def _verify_tap(tap: SunTap, card: Card | None) -> SunVerdict:
+    verdict = SunVerdict(external_id=tap.external_id, p=tap.p, valid=False)
+    if not card:
+        verdict.reason = "Card not found."
+        return verdict
+    if not card.enable:
+        verdict.reason = "Card is disabled."
+        return verdict
+    try:
+        sun, cmac = bytes.fromhex(tap.p), bytes.fromhex(tap.c)
+        verdict.reason = "Card UID mis-match."
+        for keys in card.sun_keys():
+            card_uid, counter = keys.decrypt_sun(sun)
+            if card_uid != keys.uid:
+                continue
+            if hmac.compare_digest(keys.get_sun_mac(card_uid, counter), cmac):
+                verdict.valid = True
+                verdict.reason = None
+                verdict.counter = int.from_bytes(counter, "little")
+                break
+            verdict.reason = "CMAC does not check."
+    except Exception:
+        verdict.reason = "Error decrypting card."
+    return verdict
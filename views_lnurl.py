@@ -1,3 +1,4 @@
+import hmac
 import json
 import secrets
 from http import HTTPStatus
@@ -5,10 +6,12 @@ from urllib.parse import urlparse
 
 import bolt11
 from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
 from lnbits.core.services import create_invoice, pay_invoice
 from lnurl import (
     CallbackUrl,
     LightningInvoice,
+    Lnurl,
     LnurlErrorResponse,
     LnurlPayActionResponse,
     LnurlPayMetadata,
@@ -28,38 +31,74 @@ from .crud import (
     get_card_by_otp,
     get_card_by_uid,
     get_hit,
-    get_hits_today,
+    get_spent_today,
+    retire_previous_keys,
     spend_hit,
     update_card_counter,
     update_card_otp,
 )
+from .metrics import MetricsRoute, stage
 from .models import UIDPost
-from .nxp424 import decrypt_sun, get_sun_mac
+from .ratelimit import TokenBucketLimiter
+from .settings import boltcards_settings
 
-boltcards_lnurl_router = APIRouter()
+boltcards_lnurl_router = APIRouter(route_class=MetricsRoute)
+
+card_limiter = TokenBucketLimiter(
+    boltcards_settings.scan_rate_per_card, boltcards_settings.scan_burst_per_card
+)
+ip_limiter = TokenBucketLimiter(
+    boltcards_settings.scan_rate_per_ip, boltcards_settings.scan_burst_per_ip
+)
+
+
+def _client_ip(request: Request) -> str | None:
+    if "x-real-ip" in request.headers:
+        return request.headers["x-real-ip"]
+    if "x-forwarded-for" in request.headers:
+        return request.headers["x-forwarded-for"]
+    return request.client.host if request.client else None
 
 
 # /boltcards/api/v1/scan?p=00000000000000000000000000000000&c=0000000000000000
-@boltcards_lnurl_router.get("/api/v1/scan/{external_id}")
+@boltcards_lnurl_router.get(
+    "/api/v1/scan/{external_id}",
+    response_model=LnurlWithdrawResponse | LnurlErrorResponse,
+)
 async def api_scan(
     p, c, request: Request, external_id: str
-) -> LnurlWithdrawResponse | LnurlErrorResponse:
-    # some wallets send everything as lower case, no bueno
-    p = p.upper()
-    c = c.upper()
+) -> LnurlWithdrawResponse | LnurlErrorResponse | JSONResponse:
+    # throttle before any database or crypto work
+    ip = _client_ip(request)
+    if not card_limiter.allow(external_id.lower()) or (ip and not ip_limiter.allow(ip)):
+        return LnurlErrorResponse(reason="Too many requests.")
+
     card = None
     counter = b""
-    card = await get_card_by_external_id(external_id)
+    with stage("db_lookup"):
+        card = await get_card_by_external_id(external_id)
     if not card:
         return LnurlErrorResponse(reason="Card not found.")
     if not card.enable:
         return LnurlErrorResponse(reason="Card is disabled.")
     try:
-        card_uid, counter = decrypt_sun(bytes.fromhex(p), bytes.fromhex(card.k1))
-        if card.uid.upper() != card_uid.hex().upper():
-            return LnurlErrorResponse(reason="Card UID mis-match.")
-        if c != get_sun_mac(card_uid, counter, bytes.fromhex(card.k2)).hex().upper():
-            return LnurlErrorResponse(reason="CMAC does not check.")
+        sun, cmac = bytes.fromhex(p), bytes.fromhex(c)
+        # after a key rotation the card may still have the previous keys,
+        # which costs one more block decrypt and only for those taps
+        reason = "Card UID mis-match."
+        for version, keys in enumerate(card.sun_keys()):
+            with stage("sun_decrypt"):
+                card_uid, counter = keys.decrypt_sun(sun)
+            if card_uid != keys.uid:
+                continue
+            with stage("sun_mac"):
+                mac = keys.get_sun_mac(card_uid, counter)
+            if hmac.compare_digest(mac, cmac):
+                key_version = version
+                break
+            reason = "CMAC does not check."
+        else:
+            return LnurlErrorResponse(reason=reason)
     except Exception:
         return LnurlErrorResponse(reason="Error decrypting card.")
 
@@ -68,26 +107,25 @@ async def api_scan(
     if ctr_int <= card.counter:
         return LnurlErrorResponse(reason="This link is already used.")
 
-    await update_card_counter(ctr_int, card.id)
+    with stage("counter_update"):
+        updated = await update_card_counter(ctr_int, card.id)
+    if not updated:
+        return LnurlErrorResponse(reason="This link is already used.")
+    if key_version == 0 and card.rotating:
+        await retire_previous_keys(card.id)
 
     # gathering some info for hit record
-    if not request.client:
+    if not ip:
         return LnurlErrorResponse(reason="Cannot get client info.")
-    ip = request.client.host
-    if "x-real-ip" in request.headers:
-        ip = request.headers["x-real-ip"]
-    elif "x-forwarded-for" in request.headers:
-        ip = request.headers["x-forwarded-for"]
-
     agent = request.headers["user-agent"] if "user-agent" in request.headers else ""
-    todays_hits = await get_hits_today(card.id)
-
-    hits_amount = 0
-    for hit in todays_hits:
-        hits_amount += hit.amount
-    if hits_amount > int(card.daily_limit):
+    with stage("limit_check"):
+        spent_today = await get_spent_today(card.id)
+    if spent_today > int(card.daily_limit):
         return LnurlErrorResponse(reason="Max daily limit spent.")
-    hit = await create_hit(card.id, ip, agent, card.counter, ctr_int)
+    with stage("hit_insert"):
+        hit = await create_hit(
+            card.id, ip, agent, card.counter, ctr_int, key_version=key_version
+        )
 
     # create a lud17 lnurlp to support lud19, add payLink field of the withdrawRequest
     lnurlpay_url = str(request.url_for("boltcards.lnurlp_response", hit_id=hit.id))
@@ -97,14 +135,17 @@ async def api_scan(
     callback_url = parse_obj_as(
         CallbackUrl, str(request.url_for("boltcards.lnurl_callback", hit_id=hit.id))
     )
-    return LnurlWithdrawResponse(
+    response = LnurlWithdrawResponse(
         callback=callback_url,
         k1=hit.id,
         minWithdrawable=MilliSatoshi(1000),
         maxWithdrawable=MilliSatoshi(int(card.tx_limit) * 1000),
         defaultDescription=f"Boltcard (refund address {pay_link})",
-        payLink=pay_link,  # type: ignore
+        payLink=parse_obj_as(Lnurl, pay_link),
     )
+    # the model renders payLink as https:// and then rejects it when the
+    # response is validated, so it is sent with its lnurlp:// scheme as is
+    return JSONResponse({**json.loads(response.json()), "payLink": pay_link})
 
 
 @boltcards_lnurl_router.get(
@@ -122,11 +163,6 @@ async def lnurl_callback(
     if k1 != hit_id:
         return LnurlErrorResponse(reason="K1 token does not match.")
 
-    hit = await get_hit(hit_id)
-    if not hit:
-        return LnurlErrorResponse(reason="LNURL-withdraw record not found.")
-    if hit.spent:
-        return LnurlErrorResponse(reason="Payment already claimed.")
     if not pr:
         return LnurlErrorResponse(reason="Missing payment request.")
 
@@ -136,26 +172,33 @@ async def lnurl_callback(
         return LnurlErrorResponse(reason="Failed to decode payment request.")
     if not invoice.amount_msat:
         return LnurlErrorResponse(reason="Invoice has no amount.")
-    card = await get_card(hit.card_id)
+
+    # claiming the hit is atomic, concurrent callbacks for it get None here
+    with stage("hit_claim"):
+        hit = await spend_hit(hit_id=hit_id, amount=int(invoice.amount_msat / 1000))
+    if not hit:
+        if await get_hit(hit_id):
+            return LnurlErrorResponse(reason="Payment already claimed.")
+        return LnurlErrorResponse(reason="LNURL-withdraw record not found.")
+    with stage("db_lookup"):
+        card = await get_card(hit.card_id)
     if not card:
         return LnurlErrorResponse(reason="Card not found.")
-    hit = await spend_hit(card_id=hit.id, amount=int(invoice.amount_msat / 1000))
-    if not hit:
-        return LnurlErrorResponse(reason="Failed to update hit as spent.")
     try:
-        await pay_invoice(
-            wallet_id=card.wallet,
-            payment_request=pr,
-            max_sat=int(card.tx_limit),
-            extra={"tag": "boltcards", "hit": hit.id},
-        )
+        with stage("payment"):
+            await pay_invoice(
+                wallet_id=card.wallet,
+                payment_request=pr,
+                max_sat=int(card.tx_limit),
+                extra={"tag": "boltcards", "hit": hit.id},
+            )
         return LnurlSuccessResponse()
     except Exception as exc:
         return LnurlErrorResponse(reason=f"Payment failed - {exc}")
 
 
 # /boltcards/api/v1/auth?a=00000000000000000000000000000000
-@boltcards_lnurl_router.get("/api/v1/auth")
+@boltcards_lnurl_router.get("/api/v1/auth", name="boltcards.api_auth")
 async def api_auth(a, request: Request):
     if a == "00000000000000000000000000000000":
         response = {"k0": "0" * 32, "k1": "1" * 32, "k2": "2" * 32}
@@ -212,14 +255,18 @@ async def api_auth_post(a: str, request: Request, data: UIDPost, wipe: bool = Fa
     lnurlw_base = (
         f"{urlparse(str(request.url)).netloc}/boltcards/api/v1/scan/{card.external_id}"
     )
+    k0, k1, k2 = card.k0, card.k1, card.k2
+    if wipe and card.rotating:
+        # until it taps with the new keys the card still holds the previous ones
+        k0, k1, k2 = card.prev_k0, card.prev_k1, card.prev_k2
     response = {
         "CARD_NAME": card.card_name,
         "ID": str(1),
-        "K0": card.k0,
-        "K1": card.k1,
-        "K2": card.k2,
-        "K3": card.k1,
-        "K4": card.k2,
+        "K0": k0,
+        "K1": k1,
+        "K2": k2,
+        "K3": k1,
+        "K4": k2,
         "LNURLW_BASE": "LNURLW://" + lnurlw_base,
         "LNURLW": "LNURLW://" + lnurlw_base,
         "PROTOCOL_NAME": "NEW_BOLT_CARD_RESPONSE",